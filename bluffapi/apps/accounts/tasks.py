@@ -1,7 +1,7 @@
 from celery.decorators import task
 from celery.utils.log import get_task_logger
 from time import sleep
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, get_connection, send_mail
 logger = get_task_logger(__name__)
 
 
@@ -15,3 +15,19 @@ def send_signup_mail(subject, message, email_from, recipient_list):
 def send_invite_mail(subject, message, email_from, recipient_list):
     send_mail(subject, message, email_from, recipient_list)
     return('Invite Mail send')
+
+
+@task(name='send_invite_mails')
+def send_invite_mails(datatuple):
+    '''
+    Sends invite mails of (subject, message, email_from, recipient_list)
+    over a single connection
+    '''
+    connection = get_connection()
+    messages = [
+        EmailMessage(subject, message, email_from, recipient_list,
+                     connection=connection)
+        for subject, message, email_from, recipient_list in datatuple
+    ]
+    sent = connection.send_messages(messages)
+    return(f'{sent} Invite Mails send')
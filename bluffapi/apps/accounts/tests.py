@@ -1,3 +1,5 @@
+from django.core import mail
+from django.core.mail.backends import locmem
 from django.test import TestCase
 from apps.accounts.models import User
 from django.urls import reverse
@@ -6,6 +8,12 @@ from rest_framework.response import Response
 from ddf import G
 from rest_framework.authtoken.models import Token
 from django.contrib.auth.hashers import make_password
+from rest_framework.exceptions import AuthenticationFailed
+
+from apps.accounts.tasks import send_invite_mails
+from bluffapi.token_auth import (
+    CachedTokenAuthentication, TokenCache, token_cache
+)
 
 
 class UserTest(TestCase):
@@ -145,3 +153,78 @@ class LogoutTest(TestCase):
         }
         response = self.client.post(reverse('logout'), **auth_headers)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TokenCacheTest(TestCase):
+    '''
+    Test to check caching of token lookups
+    '''
+
+    def setUp(self):
+        token_cache.clear()
+
+    def test_logout_invalidates_cached_token(self):
+        user = G(User, email='a@b.com', password=make_password('a12345678'))
+        token = G(Token, user=user)
+        authentication = CachedTokenAuthentication()
+        with self.assertNumQueries(1):
+            authentication.authenticate_credentials(token.key)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                authentication.authenticate_credentials(token.key)[0], user)
+        response = self.client.delete(reverse('logout'), **{
+            'HTTP_AUTHORIZATION': 'Token ' + token.key,
+        })
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        with self.assertRaises(AuthenticationFailed):
+            authentication.authenticate_credentials(token.key)
+
+    def test_cache_is_bounded(self):
+        cache = TokenCache(maxsize=2, ttl=60)
+        users = [G(User) for i in range(3)]
+        for key, user in zip('abc', users):
+            cache.set(key, user)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), users[2])
+        # requests get users of their own
+        cache.get('c').name = 'changed'
+        self.assertIsNot(cache.get('c'), users[2])
+        self.assertEqual(cache.get('c').name, users[2].name)
+        expired = TokenCache(maxsize=2, ttl=0)
+        expired.set('a', users[0])
+        self.assertIsNone(expired.get('a'))
+
+
+class CountingEmailBackend(locmem.EmailBackend):
+    '''
+    Keeps mails in mail.outbox and counts connections opened and
+    send_messages calls made
+    '''
+    connections = 0
+    sends = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        CountingEmailBackend.connections += 1
+
+    def send_messages(self, messages):
+        CountingEmailBackend.sends += 1
+        return super().send_messages(messages)
+
+
+class InviteMailsTest(TestCase):
+
+    def test_mails_sent_over_one_connection(self):
+        CountingEmailBackend.connections = CountingEmailBackend.sends = 0
+        recipients = [f'player{i}@b.com' for i in range(3)]
+        with self.settings(
+                EMAIL_BACKEND='apps.accounts.tests.CountingEmailBackend'):
+            result = send_invite_mails([
+                ('Invite', 'join', 'owner@b.com', [recipient])
+                for recipient in recipients
+            ])
+        self.assertEqual(result, '3 Invite Mails send')
+        self.assertEqual([message.to for message in mail.outbox],
+                         [[recipient] for recipient in recipients])
+        self.assertEqual(CountingEmailBackend.connections, 1)
+        self.assertEqual(CountingEmailBackend.sends, 1)
@@ -3,12 +3,12 @@ from django.contrib.auth import authenticate
 from rest_framework import viewsets, permissions
 from rest_framework.generics import CreateAPIView, DestroyAPIView
 from rest_framework.authtoken.models import Token
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.response import Response
 from rest_framework import status
 from django.core.mail import send_mail
 from django.conf import settings
 from apps.accounts.tasks import send_signup_mail
+from bluffapi.token_auth import CachedTokenAuthentication, token_cache
 
 from apps.accounts import (
     models as accounts_models, serializers as accounts_serializers,
@@ -52,9 +52,10 @@ class LogoutView(DestroyAPIView):
     '''
     It deletes the token and logsout user
     '''
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = [permissions.IsAuthenticated]
 
     def delete(self, request):
         Token.objects.filter(user=request.user).delete()
+        token_cache.invalidate_user(request.user.id)
         return Response(status=status.HTTP_204_NO_CONTENT)
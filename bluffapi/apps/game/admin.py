@@ -4,3 +4,5 @@ from apps.game import models as game_models
 admin.site.register(game_models.Game)
 admin.site.register(game_models.GamePlayer)
 admin.site.register(game_models.GameTableSnapshot)
+admin.site.register(game_models.PlayerDailyStats)
+admin.site.register(game_models.GameEvent)
@@ -0,0 +1,131 @@
+import random
+
+from apps.game import constants as game_constants
+
+# Cards are laid out as 52 cards * MAX_DECKS copies, so one rank spans
+# 4 suits * MAX_DECKS consecutive indexes
+MAX_DECKS = game_constants.MAX_CARD_LENGTH // 52
+CARDS_PER_RANK = 4 * MAX_DECKS
+CARD_BYTES = (game_constants.MAX_CARD_LENGTH + 7) // 8
+ALL_CARDS_MASK = (1 << game_constants.MAX_CARD_LENGTH) - 1
+RANK_MASKS = {
+    rank: ((1 << CARDS_PER_RANK) - 1) << (CARDS_PER_RANK * (rank - 1))
+    for rank in range(1, 14)
+}
+
+
+class CardSet:
+    '''
+    Immutable set of cards packed into an integer
+    bit i is set when card at index i of the '0'/'1' card string is present
+    '''
+    __slots__ = ('_bits',)
+
+    def __init__(self, bits=0):
+        if bits < 0 or bits > ALL_CARDS_MASK:
+            raise ValueError('Cards out of range')
+        self._bits = bits
+
+    @classmethod
+    def from_string(cls, cards):
+        '''
+        Builds CardSet from string of length MAX_CARD_LENGTH made of 0 and 1
+        '''
+        if not isinstance(cards, str) \
+                or len(cards) != game_constants.MAX_CARD_LENGTH \
+                or cards.strip('01'):
+            raise ValueError('Invalid cards config')
+        return cls(int(cards[::-1], 2))
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''Builds CardSet from its packed (little endian) representation'''
+        return cls(int.from_bytes(data, 'little'))
+
+    @classmethod
+    def full(cls, decks):
+        '''Returns all the cards of given number of decks'''
+        per_card = (1 << decks) - 1
+        bits = 0
+        for card in range(52):
+            bits |= per_card << (card * MAX_DECKS)
+        return cls(bits)
+
+    @property
+    def bits(self):
+        return self._bits
+
+    def to_string(self):
+        '''Returns '0'/'1' string of length MAX_CARD_LENGTH'''
+        return format(
+            self._bits, f'0{game_constants.MAX_CARD_LENGTH}b')[::-1]
+
+    def to_bytes(self):
+        '''Returns packed (little endian) representation of cards'''
+        return self._bits.to_bytes(CARD_BYTES, 'little')
+
+    def count(self):
+        '''Returns no of cards in the set'''
+        return bin(self._bits).count('1')
+
+    def from_rank(self, rank):
+        '''
+        Whether all cards belong to given rank
+        An empty set belongs to every rank
+        '''
+        return not self._bits & ~RANK_MASKS.get(rank, 0)
+
+    def issubset(self, other):
+        return not self._bits & ~other._bits
+
+    def __or__(self, other):
+        return CardSet(self._bits | other._bits)
+
+    def __and__(self, other):
+        return CardSet(self._bits & other._bits)
+
+    def __sub__(self, other):
+        return CardSet(self._bits & ~other._bits)
+
+    def __contains__(self, index):
+        return bool(self._bits >> index & 1)
+
+    def __iter__(self):
+        '''Yields indexes of the cards present'''
+        bits = self._bits
+        while bits:
+            lowest = bits & -bits
+            yield lowest.bit_length() - 1
+            bits ^= lowest
+
+    def __len__(self):
+        return self.count()
+
+    def __bool__(self):
+        return self._bits != 0
+
+    def __eq__(self, other):
+        return isinstance(other, CardSet) and self._bits == other._bits
+
+    def __hash__(self):
+        return hash(self._bits)
+
+    def __repr__(self):
+        return f'CardSet({self.count()} cards)'
+
+
+def deal(cards, hand_count, rng=random):
+    '''
+    Shuffles cards once and slices them into hand_count equal hands
+    Returns list of CardSets, cards which can not be dealt equally are left out
+    '''
+    card_list = list(cards)
+    rng.shuffle(card_list)
+    cards_per_hand = len(card_list) // hand_count
+    hands = []
+    for start in range(0, cards_per_hand * hand_count, cards_per_hand):
+        bits = 0
+        for card in card_list[start:start + cards_per_hand]:
+            bits |= 1 << card
+        hands.append(CardSet(bits))
+    return hands
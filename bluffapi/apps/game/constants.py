@@ -2,3 +2,7 @@ MAX_CARD_LENGTH = 156  # Should always be a multiple of 52
 SUBJECT = 'Invitation to play a game'
 MESSAGE = 'you are invited to play a bluff game by'
 DOMAIN = 'http://localhost:3000'
+STATE_FLUSH_INTERVAL = 1  # seconds between writes of in memory game states
+RESUME_BUFFER_SIZE = 64  # updates of a game kept to replay on reconnect
+CHECKPOINT_INTERVAL = 20  # versions of a game between full table snapshots
+MAX_INVITES = 8  # players invited by one bulk invite
@@ -1,24 +1,40 @@
-import json
-import random
-import math
+import asyncio
+import atexit
+import logging
 
-from django.db.models import Q, F
-from django.db import transaction
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer, WebsocketConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
 
-from channels.generic.websocket import WebsocketConsumer
+from urllib.parse import parse_qs
 
 from apps.game.serializers import *
 from apps.game.models import *
 from asgiref.sync import async_to_sync
-from apps.game import constants as game_constants
+from apps.game.cards import RANK_MASKS, CardSet, deal
+from apps.game.state import game_states
+from apps.game.timers import game_timers, in_worker, main_event_loop
+from apps.game import metrics, protocol, rules
 
+logger = logging.getLogger(__name__)
 
-class GameConsumer(WebsocketConsumer):
+
+class GameActionsMixin:
     '''
-    It calles desired function whenever an event happens
+    Game logic shared by the sync and async consumers
+    Actions run against the in memory GameState of the game,
+    which writes them to the database in batches
+    Every action returns the event to send to the game group, if any
     '''
     game_player = None
     actions = None
+    codec = protocol.json_codec
+    delta_updates = False  # client wants patches instead of full states
+    last_seq = 0  # sequence number of last game state sent to the client
+    last_self = None  # private part of last game state sent to the client
+    resume_from = None  # (epoch, seq) of last update the client got
+    event_loop = None  # loop of the server, when running on a timer
 
     def __init__(self, *args, **kwargs):
         '''calls functions to run based on the actions it get'''
@@ -30,430 +46,849 @@ class GameConsumer(WebsocketConsumer):
             'callBluff': self.call_bluff,
             'skip': self.skip,
         }
+        # actions answered only to the client asking for them
+        self.private_actions = {
+            'snapshot': self.snapshot_message,
+        }
 
-    def connect(self):
-        '''
-        initializes gamplayer instance, sends gameState
-        and connects you to the game
-        '''
-        if not self.scope['user'].is_authenticated():
-            self.close()
-            return
+    def tracked(self, record, function, *args):
+        '''Runs function counting its queries in record'''
+        with record.tracking():
+            return function(*args)
+
+    def init_room(self):
+        # Only the worker serving sockets has games to drain as it exits
+        register_drain()
         self.room_name = self.scope['url_route']['kwargs']['game_id']
         self.room_group_name = f'game_{self.room_name}'
-        async_to_sync(self.channel_layer.group_add)(
-            self.room_group_name,
-            self.channel_name
-        )
-        self.accept()
-        request_data = {
-            'game': self.room_name,
-            'user': self.scope['user'].id
-            # 'user': 1  # FOR TESTING ONLY, REPLACE WITH ABOVE LINE
-        }
-        # Initialize self variables,update gameplayer , send game state
-        serializer = SocketInitSerializer(data=request_data)
+        # msgpack frames are sent when the client asks for them
+        self.codec = protocol.negotiate(self.scope)
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.delta_updates = query.get('updates') == ['delta']
         try:
-            serializer.is_valid(raise_exception=True)
-            self.game_player = serializer.validated_data['game_player']
-            # assign a player_id, set disconnected to false
-            if self.game_player.player_id is None:
-                last_player = self.game_player.game.gameplayer_set.filter(
-                    player_id__isnull=False
-                ).order_by('player_id').last()
-                # If no one has been assigned any player_id, last_player is none
-                if last_player:
-                    last_player_id = last_player.player_id
-                else:
-                    last_player_id = 0
-                if last_player_id >= 9:
-                    raise Exception('Game is Full')
-                data_update = {
-                    'disconnected': False,
-                    'player_id': last_player_id+1
-                }
+            self.resume_from = (query['epoch'][0], int(query['seq'][0]))
+        except (KeyError, ValueError):
+            self.resume_from = None
 
-            else:
-                data_update = {
-                    'disconnected': False
-                }
-            connected_players = GamePlayer.objects.filter(
-                game=self.game_player.game, disconnected=False)
-            if not connected_players.exists():
+    def join_game(self, user_id):
+        '''
+        initializes gamplayer instance and connects you to the game
+        Returns game state to send to the player and event for the group
+        '''
+        if game_states.draining:
+            raise Exception('Server is restarting')
+        try:
+            with game_states.locked(self.room_name) as state:
+                return self.join_state(state, user_id)
+        except Game.DoesNotExist:
+            self.validate_player(user_id)
+            raise
+
+    def validate_player(self, user_id):
+        '''Returns GamePlayer of the user, raises why he can not join'''
+        serializer = SocketInitSerializer(data={
+            'game': self.room_name,
+            'user': user_id
+        })
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data['game_player']
+
+    def join_state(self, state, user_id):
+        '''
+        Joins the game kept in state, players loaded with it are found
+        without queries. A new player is seated and connected by one
+        UPDATE, a returning one is connected on next flush
+        '''
+        game_player = state.player_for_user(user_id)
+        if game_player is None:
+            # Invited after the state was loaded, or not invited at all
+            try:
+                game_player = self.validate_player(user_id)
+            except exceptions.ValidationError:
+                if not state.sockets:
+                    game_states.release(self.room_name)
+                raise
+        elif game_player.player_id is None and state.game.started:
+            raise Exception('Game already started, cannot join')
+        self.game_player = state.add_player(game_player)
+        # assign a player_id, set disconnected to false
+        if self.game_player.player_id is None:
+            player_id = self.game_player.take_seat(settings.TABLE_SIZE)
+            if player_id is None:
+                self.game_player = None
+                raise Exception('Game is Full')
+            state.seat_player(self.game_player, player_id)
+        if state.attach(self.game_player):
+            # Back within the grace period, nobody was told he left
+            event = None
+            public_state, seq = state.public_state, state.seq
+        else:
+            if not state.connected_players():
                 # check if game is started
-                game = Game.objects.get(id=self.game_player.game.id)
-                if game.started and game.winner is None:
-                    last_snapshot = GameTableSnapshot.objects.filter(
-                        game=self.game_player.game).latest('updated_at')
-                    last_snapshot.current_user = self.game_player
-                    last_snapshot.save()
-
-            update_serializer = SocketGamePlayerSerializer(
-                self.game_player, data=data_update, partial=True)
-            update_serializer.is_valid(raise_exception=True)
-            update_serializer.save()
-            self.send(text_data=json.dumps({
-                'init_success': True,
-                **self.update_game_state(request_data['user'])
-            }))
-        except Exception as e:
-            self.send(text_data=json.dumps({
-                'init_success': False,
-                'message': e.__str__()
-            }))
-            self.close()
-            return
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
+                if state.game.started and state.game.winner is None:
+                    state.push_table('join', self.game_player,
+                                     current_user=self.game_player)
+            state.set_connected(self.game_player, True)
+            event = self.publish(state, {
                 'type': 'play_cards'
-            }
-        )
+            })
+            public_state, seq = event['game_state'], event['seq']
+        epoch = state.epoch
+        game_state = self.update_game_state(public_state)
+        self.last_seq, self.last_self = seq, game_state['self']
+        return {**game_state, 'seq': seq, 'epoch': epoch}, event
 
-    def disconnect(self, close_code):
+    def resume_game(self, user_id):
+        '''
+        Reconnects a seated player to a game kept in memory without
+        telling other players, when updates he missed are still kept
+        Returns messages to send to the player, None when he has to join
+        '''
+        state = game_states.peek(self.room_name)
+        if state is None:
+            return None
+        epoch, seq = self.resume_from
+        with state.lock:
+            player = state.player_for_user(user_id)
+            missed = state.events_since(epoch, seq)
+            if state.released or missed is None or player is None \
+                    or player.player_id is None:
+                return None
+            self.game_player = player
+            state.attach(player)
+            if player.disconnected:
+                state.set_connected(player, True)
+        self.last_seq = seq
+        messages = [{
+            'init_success': True,
+            'resumed': True,
+            'epoch': epoch,
+            'seq': seq,
+        }]
+        for event in missed:
+            message = self.push_message(event)
+            if message is not None:
+                messages.append(message)
+        return messages
+
+    def leave_game(self):
+        '''
+        Called when a socket of the player closes
+        He is disconnected once his last socket is closed for
+        DISCONNECT_GRACE_PERIOD seconds, so that a flaky connection
+        does not skip his turn and flood the group with updates
+        Returns event for the group, None while he is still connected
         '''
-        Skips turn if its players turn ans game is started and runs 
+        if game_states.draining:
+            # Whole worker is leaving, see drain_games
+            return None
+        with game_states.locked(self.room_name) as state:
+            if not state.detach(self.game_player):
+                # Another socket of him is still open
+                return None
+            if settings.DISCONNECT_GRACE_PERIOD > 0:
+                game_timers.schedule(
+                    state.disconnect_key(self.game_player),
+                    settings.DISCONNECT_GRACE_PERIOD,
+                    in_worker(self.leave_after_grace_period),
+                    main_event_loop())
+                return None
+        return self.finish_leaving()
+
+    def leave_after_grace_period(self, loop):
+        '''Disconnects the player from a timer worker'''
+        self.event_loop = loop
+        record = metrics.ActionRecord('disconnect')
+        event = self.tracked(record, self.finish_leaving)
+        if event is not None:
+            self.send_from_timer(event, record)
+        record.finish()
+
+    def send_from_timer(self, event, record):
+        '''Sends event to the group on the event loop of the server'''
+        with record.timed('channel'):
+            if self.event_loop is None:
+                async_to_sync(self.channel_layer.group_send)(
+                    self.room_group_name, event)
+            else:
+                asyncio.run_coroutine_threadsafe(
+                    self.channel_layer.group_send(
+                        self.room_group_name, event), self.event_loop)
+
+    def schedule_turn_timeout(self, state):
+        '''
+        Starts turn timer of current player when the table changed
+        Only one timer runs per game, it is replaced on every turn
+        '''
+        table = state.table
+        if state.timed_table is table:
+            return
+        state.timed_table = table
+        key = ('turn', state.game_id)
+        if settings.TURN_TIMEOUT <= 0 or table is None \
+                or table.current_user_id is None \
+                or not state.game.started or state.game.winner is not None:
+            game_timers.cancel(key)
+            return
+        game_timers.schedule(
+            key, settings.TURN_TIMEOUT, in_worker(self.turn_timed_out),
+            table, main_event_loop() or self.event_loop)
+
+    def turn_timed_out(self, table, loop):
+        '''
+        Skips turn of current player from a timer worker, with a
+        consumer of its own as this one may belong to another player
+        '''
+        consumer = GameActionsMixin()
+        consumer.room_name = self.room_name
+        consumer.room_group_name = self.room_group_name
+        consumer.channel_layer = self.channel_layer
+        consumer.event_loop = loop
+        record = metrics.ActionRecord('turn_timeout')
+        event = consumer.tracked(record, consumer.skip_idle_turn, table)
+        if event is not None:
+            consumer.send_from_timer(event, record)
+        record.finish()
+
+    def skip_idle_turn(self, table):
+        '''
+        Skips turn of the player in turn on table if the table did not
+        change and counts it in his no_action
+        '''
+        state = game_states.peek(self.room_name)
+        if state is None or game_states.draining:
+            return None
+        with state.lock:
+            if state.released or state.table is not table:
+                return None
+            self.game_player = rules.player_in_turn(table, state.ring)
+            if self.game_player is None:
+                return None
+            event = self.skip('Turn Timeout')
+            if event is None:
+                return None
+            self.game_player.no_action += 1
+            state.mark_dirty(self.game_player, 'no_action')
+            return self.publish(state, event)
+
+    def finish_leaving(self):
+        '''
+        Skips turn if its players turn ans game is started and runs
         Clean up code when user disconnects
         '''
-        if self.game_player:
-            self.game_player = GamePlayer.objects.\
-                select_related('game').get(id=self.game_player.id)
+        if game_states.draining:
+            return None
+        event = {
+            'type': 'play_cards'
+        }
+        with game_states.locked(self.room_name) as state:
+            self.game_player = state.get_player(self.game_player.id)
+            if state.sockets[self.game_player.id]:
+                # He came back meanwhile
+                return None
             # Check if he was current user
-            last_snapshot = GameTableSnapshot.objects.filter(
-                game=self.game_player.game).latest('updated_at')
-            if last_snapshot.current_user == self.game_player \
-                    and self.game_player.game.started:
+            if state.table.current_user == self.game_player \
+                    and state.game.started:
                 # Make him skip his turn
-                self.skip('Forced Skip')
-            update_serializer = SocketGamePlayerSerializer(
-                self.game_player, data={'disconnected': True}, partial=True)
-            update_serializer.is_valid(raise_exception=True)
-            update_serializer.save()
-            async_to_sync(self.channel_layer.group_send)(
-                self.room_group_name,
-                {
-                    'type': 'play_cards'
-                }
-            )
-            self.close()
+                event = self.skip('Forced Skip') or event
+            state.set_connected(self.game_player, False)
+            everyone_left = not state.connected_players()
+            self.publish(state, event)
+        if everyone_left:
+            # Nobody is left to play, write the game and forget it
+            game_states.release(self.room_name)
+        return event
 
-    def update_game_state(self, user_id):
+    def drain_state(self, state):
         '''
-        Returns object conatining game_state having details 
-        of game,players,self and table
+        Disconnects every player of state as the worker stops, skipping
+        the turn of the player in turn once for all of them
+        Returns event for the group, None when nobody was connected
         '''
-        game = Game.objects.prefetch_related(
-            'gameplayer_set').get(id=self.game_player.game.id)
-        game_players = game.gameplayer_set.order_by('player_id').filter(
-            ~Q(user=user_id) & Q(player_id__isnull=False))  # filter() To be replaced with line below
-        # filter(~Q(user=user_id) && Q(player_id__isnull=False))#Only return people who have joined
-        myself = game.gameplayer_set.get(user=user_id)
-        game_table = game.gametablesnapshot_set.latest('updated_at')
-        game_state = {
-            'game': SocketGameSerializer(game).data,
-            'game_players': SocketGamePlayerSerializer(game_players, many=True).data,
-            'self': SocketMyselfSerializer(myself).data,
-            'game_table': SocketGameTableSerializer(game_table).data,
+        if not state.connected_players():
+            return None
+        event = {
+            'type': 'play_cards'
         }
-        return game_state
-
-    def get_next_player(self, showAll=False):
-        '''
-        Default: returns next connected player in player circle
-        showAll = True : returns next player in player circle
-        '''
-        # minimum one player should be there in game with player_id set
-        # current player is assumed to be myself
-        all_players = GamePlayer.objects.filter(
-            Q(player_id__isnull=False) & Q(game=self.game_player.game))
-        # When not testing Replace above line with follwing to process only connected players
-        # all_players = self.game_player.game.gameplayer_set.filter(
-        #     ~Q(player_id=None) & Q(disconnected=False))
-
-        player_count = all_players.count()
-        self_id = self.game_player.player_id
-        all_players = all_players.annotate(
-            distance=(F('player_id')-self_id+player_count) % player_count)
-        if showAll:
-            result = all_players.filter(
-                ~Q(distance=0)).order_by('distance').first()
-        else:
-            result = all_players.filter(
-                ~Q(distance=0) & Q(disconnected=False)).order_by('distance').first()
-        return result
+        in_turn = rules.player_in_turn(state.table, state.ring) \
+            if state.table is not None else None
+        if in_turn is not None and state.game.started \
+                and state.game.winner is None:
+            self.game_player = in_turn
+            event = self.skip('Forced Skip') or event
+        state.disconnect_all()
+        return self.publish(state, event)
 
-    def is_it_my_turn(self):
-        '''Checks if it's turn of current user
+    def perform_action(self, action, data):
         '''
-        current_snapshot = GameTableSnapshot.objects.filter(
-            game=self.game_player.game).order_by('updated_at').last()
-        if current_snapshot.current_user and current_snapshot.current_user.disconnected == True:
-            if self.game_player == self.get_next_player():
-                return True
-        elif current_snapshot.current_user == self.game_player:
-            return True
-        return False
+        Runs the action and adds public game state to its event,
+        so that it is computed once instead of once per player
+        '''
+        with game_states.locked(self.room_name) as state:
+            event = action(data)
+            if event:
+                self.publish(state, event)
+        return event
+
+    def publish(self, state, event):
+        '''
+        Adds public game state, its sequence number and its changes
+        from the previous state to the event, and the hand of every
+        player read while holding the lock of state
+        '''
+        event['game_state'] = self.public_game_state()
+        with metrics.timed('serialize'):
+            # keys are strings, as the channel layer may pack with msgpack
+            event['hands'] = {
+                str(player.id): SocketMyselfSerializer(player).data
+                for player in state.players.values()
+            }
+        state.publish(event)
+        self.schedule_turn_timeout(state)
+        return event
+
+    def public_game_state(self):
+        '''
+        Returns the part of game_state which is same for every player
+        '''
+        with game_states.locked(self.room_name) as state, \
+                metrics.timed('serialize'):
+            return {
+                'game': SocketGameSerializer(state.game).data,
+                'game_players': SocketGamePlayerSerializer(
+                    state.seated_players(), many=True).data,
+                'game_table': SocketGameTableSerializer(state.table).data,
+            }
 
-    def from_set(self, current_rank, cards):
+    def update_game_state(self, public_state=None, myself=None):
         '''
-        Whether all cards belong to given set
+        Returns object conatining game_state having details
+        of game,players,self and table
+        Only private hand is added to public_state, which is computed
+        when it is not given, as is the hand, which must then be done
+        while holding the lock of the game
         '''
-        # Assumes current_rank between 1 and 13
-        # List of indexes on which cards exist
-        card_list = [index for index, string in enumerate(cards)
-                     if string == '1']
-        for card in card_list:
-            if math.ceil((card+1)/12) != current_rank:
-                return False
-        return True
+        if public_state is None:
+            public_state = self.public_game_state()
+        user_id = self.game_player.user_id
+        with metrics.timed('serialize'):
+            if myself is None:
+                myself = SocketMyselfSerializer(self.game_player).data
+            return {
+                'game': public_state['game'],
+                'game_players': [
+                    player for player in public_state['game_players']
+                    if player['user']['id'] != user_id],
+                'self': myself,
+                'game_table': public_state['game_table'],
+            }
 
-    def cards_union(self, base_cards, new_cards):
+    def hand_of(self, event):
         '''
-        Returns a string containing cards from base_cards and new_cards
+        Returns hand of the player as it was when event was published
+        Events of older consumers have none, it is read from the game
+        then, which may load it from database
         '''
-        my_cards = bytearray(base_cards, 'utf-8')
-        for index, card in enumerate(new_cards):
-            if card == '1':
-                my_cards[index] = ord(card)
-        return my_cards.decode('utf-8')
+        myself = event.get('hands', {}).get(str(self.game_player.id))
+        if myself is None:
+            with game_states.locked(self.room_name) as state, \
+                    metrics.timed('serialize'):
+                myself = SocketMyselfSerializer(
+                    state.get_player(self.game_player.id)).data
+        return myself
+
+    def game_state_message(self, event):
+        '''Returns message sent to the socket for a play_cards event'''
+        game_state = self.update_game_state(
+            event.get('game_state'), self.hand_of(event))
+        self.last_self = game_state['self']
+        return {
+            **game_state,
+            'seq': event.get('seq'),
+            'bluff_cards': event.get('bluff_cards'),
+            'action': event.get('action'),
+            'last_player_turn': event.get('last_player_turn'),
+            'bluffLooser': event.get('bluffLooser'),
+        }
+
+    def patch_message(self, event):
+        '''
+        Returns changes of the game state since the previous event,
+        players only get their own hand
+        '''
+        patch = {key: value for key, value in event['patch'].items()
+                 if key != 'game_players'}
+        players = [player for player in event['patch'].get('game_players', [])
+                   if player['player_id'] != self.game_player.player_id]
+        if players:
+            patch['game_players'] = players
+        myself = self.hand_of(event)
+        changes = protocol.dict_patch(self.last_self or {}, myself)
+        if changes:
+            patch['self'] = changes
+        self.last_self = myself
+        return {
+            'seq': event['seq'],
+            'patch': patch,
+            'bluff_cards': event.get('bluff_cards'),
+            'action': event.get('action'),
+            'last_player_turn': event.get('last_player_turn'),
+            'bluffLooser': event.get('bluffLooser'),
+        }
+
+    def push_message(self, event):
+        '''
+        Returns message for a play_cards event
+        Nothing is sent when the client already has this update or a
+        later one, as events of concurrent actions may arrive out of order
+        Clients which asked for delta updates get a patch when they have
+        the previous state and whole state when they missed an update
+        '''
+        seq = event.get('seq')
+        if seq is None:
+            return self.game_state_message(event)
+        if seq <= self.last_seq:
+            return None
+        if self.delta_updates and seq == self.last_seq + 1 \
+                and 'patch' in event:
+            message = self.patch_message(event)
+        else:
+            message = self.game_state_message(event)
+        self.last_seq = seq
+        return message
+
+    def snapshot_message(self, data=None):
+        '''Returns whole game state along with its sequence number'''
+        with game_states.locked(self.room_name) as state:
+            self.game_player = state.get_player(self.game_player.id)
+            message = self.game_state_message({
+                'game_state': state.public_state or self.public_game_state(),
+                'seq': state.seq,
+            })
+            epoch = state.epoch
+        self.last_seq = message['seq']
+        return {**message, 'epoch': epoch}
+
+    def finish_game(self, state, winner):
+        '''Makes winner win the game and counts it for every player'''
+        state.game.winner = winner.user
+        state.mark_dirty(state.game, 'winner')
+        for player in state.seated_players():
+            state.record_stats(player.user_id, games_played=1)
+
+    def apply_outcome(self, state, outcome, action):
+        '''Stores outcome of action made with rules in state'''
+        for player, cards in outcome.hands.items():
+            player.cards = cards
+            state.mark_dirty(player, 'cards')
+        if outcome.winner is not None:
+            self.finish_game(state, outcome.winner)
+        state.push_snapshot(GameTableSnapshot(
+            game=state.game,
+            did_skip=None,
+            action=action,
+            **outcome.table.as_dict()
+        ), self.game_player)
+        if outcome.winner is not None:
+            state.flush()
 
     def call_bluff(self, data):
         '''
         Performs Call Bluff Operation if either i'm current player
         or i'm next player
         '''
-        # if current turn or current turn + 1
-        self.game_player = GamePlayer.objects.get(id=self.game_player.id)
-        last_snapshot = GameTableSnapshot.objects.filter(
-            game=self.game_player.game).latest('updated_at')
-        # check if im current user and call bluff on last player who played
-        # unless that last player is myself as well
-        # update gamestate
-        if (last_snapshot.current_user == self.game_player
-            or self.get_next_player == self.game_player) \
-                and last_snapshot.last_user != self.game_player:
-            # Check last cards and current_rank
-            if self.from_set(last_snapshot.current_rank, last_snapshot.last_cards):
-                # table cards are mine
-                self.game_player.cards = self.cards_union(
-                    self.game_player.cards, last_snapshot.cards_on_table)
-                current_user = last_snapshot.last_user  # The guy whose turn is next
-                loser = self.game_player  # the guy who lost the bluff
-                # Check if He has no cards left
-            else:
-                # table cards are his
-                last_snapshot.last_user.cards = self.cards_union(
-                    last_snapshot.last_user.cards, last_snapshot.cards_on_table)
-                current_user = self.game_player  # The guy whose turn is next
-                loser = last_snapshot.last_user  # the guy who lost the bluff
-            if last_snapshot.last_user.cards == '0'*game_constants.MAX_CARD_LENGTH:
-                # He is the winner
-                current_user = None
-                Game.objects.filter(id=self.game_player.game.id).update(
-                    winner=last_snapshot.last_user.user)
-            new_snapshot = GameTableSnapshot(
-                game=last_snapshot.game,
-                current_rank=None,
-                cards_on_table='0'*game_constants.MAX_CARD_LENGTH,
-                last_cards='0'*game_constants.MAX_CARD_LENGTH,
-                last_user=None,
-                current_user=current_user,
-                bluff_caller=self.game_player,
-                bluff_successful=True,
-                did_skip=None,
+        with game_states.locked(self.room_name) as state:
+            self.game_player = state.get_player(self.game_player.id)
+            last_snapshot = state.table
+            outcome = rules.call_bluff(last_snapshot, self.game_player,
+                                       state.ring)
+            if outcome is None:
+                return None
+            bluff_successful = outcome.table.bluff_successful
+            state.record_stats(
+                self.game_player.user_id,
+                bluffs_called=1,
+                bluffs_successful=int(bluff_successful),
+                bluffs_failed=int(not bluff_successful),
             )
-            with transaction.atomic():
-                loser.save()  # The guy whose turn is next
-                new_snapshot.save()
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                'type': 'play_cards',
-                'text': 'asdfasd',
-                'bluff_cards': last_snapshot.last_cards,
-                'action': 'Show',
-                'bluffLooser': {
-                    'userId': loser.user.id,
-                    'userName': loser.user.name
-                },
-                'last_player_turn': self.game_player.player_id
-            }
-        )
+            self.apply_outcome(state, outcome, 'callBluff')
+        loser = outcome.loser
+        return {
+            'type': 'play_cards',
+            'text': 'asdfasd',
+            'bluff_cards': last_snapshot.last_cards.to_string(),
+            'action': 'Show',
+            'bluffLooser': {
+                'userId': loser.user.id,
+                'userName': loser.user.name
+            },
+            'last_player_turn': self.game_player.player_id
+        }
 
     def skip(self, data):
         '''It skips turn of the user'''
-        self.game_player = GamePlayer.objects.get(id=self.game_player.id)
-        if not self.is_it_my_turn():
-            return
-        current_snapshot = GameTableSnapshot.objects.filter(
-            game=self.game_player.game).latest('updated_at')
-        current_snapshot.did_skip = True
-        # Check if next player(connected or not) has no cards left
-        next_joined_player = self.get_next_player(showAll=True)
-
-        # Logic to empty the table and start next round
-        # If i'm the last user who played cards
-        if current_snapshot.last_user == self.game_player:
-            # Empty the table, i begin the next round
-            next_snapshot_data = {
-                'cards_on_table': '0'*game_constants.MAX_CARD_LENGTH,
-                'current_user': self.game_player,
-                'last_user': None,
-                'current_rank': None,
-                'last_cards': '0'*game_constants.MAX_CARD_LENGTH,
-            }
-        else:  # Whoever is next
-            next_snapshot_data = {
-                'cards_on_table': current_snapshot.cards_on_table,
-                'current_user': self.get_next_player(),
-                'last_user': current_snapshot.last_user,
-                'last_cards': current_snapshot.last_cards,
-                'current_rank': current_snapshot.current_rank,
-            }
-
-        with transaction.atomic():
-            current_snapshot.save()
-            if self.game_player.game.started == True and next_joined_player.cards == '0'*game_constants.MAX_CARD_LENGTH:
-                # next player is winner
-                Game.objects.filter(id=self.game_player.game.id).update(
-                    winner=next_joined_player.user)
-                next_snapshot_data['current_user'] = None
-            new_snapshot = GameTableSnapshot(
-                game=self.game_player.game,
-                bluff_caller=None,
-                bluff_successful=None,
-                did_skip=None,
-                **next_snapshot_data
-            ).save()
-
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                'type': 'play_cards',
-                'text': 'sdfasdfasd',
-                'action': 'skip',
-                'last_player_turn': self.game_player.player_id
-            }
-        )
+        with game_states.locked(self.room_name) as state:
+            self.game_player = state.get_player(self.game_player.id)
+            outcome = rules.skip(state.table, self.game_player,
+                                 state.ring, started=state.game.started)
+            if outcome is None:
+                return None
+            self.apply_outcome(state, outcome, 'skip')
+        return {
+            'type': 'play_cards',
+            'text': 'sdfasdfasd',
+            'action': 'skip',
+            'last_player_turn': self.game_player.player_id
+        }
 
     def start_game(self, text_data):
         '''
         start a game
         distribute cards randomly
         '''
-        self.game_player = GamePlayer.objects.get(id=self.game_player.id)
-        game_table = self.game_player.game.gametablesnapshot_set.latest(
-            'updated_at')
-        # List of indexes on which cards exist
-        card_list = [index for index, string in enumerate(game_table.cards_on_table)
-                     if string == '1']
-        total_players = self.game_player.game.gameplayer_set.filter(
-            Q(player_id__isnull=False)
-        ).order_by('player_id').last().player_id
-        cards_per_player = math.floor(
-            self.game_player.game.decks*52/total_players)
-        all_player_cards = {}  # contains cards for each player after they are distributed
-
-        # distribute cards from table
-        for player_id in range(1, total_players+1):
-            # cards of current player in loop
-            my_cards = bytearray('0'*game_constants.MAX_CARD_LENGTH, 'utf-8')
-            # Get Random cards from table
-            for i in range(cards_per_player):
-                acquired_card = random.randint(0, len(card_list)-1)
-                my_cards[card_list[acquired_card]] = ord(
-                    '1')  # Add card to my cards
-                card_list.pop(acquired_card)  # Remove card from card list
-            all_player_cards[player_id] = my_cards.decode('utf-8')
-        distribute_serializer = DistributeCardsSerializer(
-            data={'all_player_cards': all_player_cards},
-            context={'game': self.game_player.game}
-        )
-        distribute_serializer.is_valid()
-        distribute_serializer.save()
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                'type': 'play_cards',
-                'text': 'sdfasdfasd',
+        with game_states.locked(self.room_name) as state:
+            self.game_player = state.get_player(self.game_player.id)
+            # Cards are distributed in database, so write pending changes first
+            state.flush()
+            total_players = state.seated_players()[-1].player_id
+            # Shuffle cards on table once and give each player a slice
+            hands = deal(state.table.cards_on_table, total_players)
+            all_player_cards = {
+                player_id: cards
+                for player_id, cards in enumerate(hands, start=1)
             }
-        )
+            distribute_serializer = DistributeCardsSerializer(
+                data={'all_player_cards': all_player_cards},
+                context={'game': state.game}
+            )
+            distribute_serializer.is_valid()
+            distribute_serializer.save()
+            state.load()
+        return {
+            'type': 'play_cards',
+            'text': 'sdfasdfasd',
+        }
 
     def update_cards(self, text_data):
         '''
         update cards on table and player cards when card is played
         '''
-        if not self.is_it_my_turn():
+        with game_states.locked(self.room_name) as state:
+            self.game_player = state.get_player(self.game_player.id)
+            try:
+                cards_played = CardSet.from_string(text_data['cardsPlayed'])
+                rank = int(text_data['set'])
+            except (KeyError, TypeError, ValueError):
+                return None
+            if rank not in RANK_MASKS:
+                return None
+            outcome = rules.play(state.table, self.game_player, cards_played,
+                                 rank, state.ring)
+            if outcome is None:
+                return None
+            self.apply_outcome(state, outcome, 'play')
+        return {
+            'type': 'play_cards',
+            'text': text_data,
+            'action': f"played {cards_played.count()} card",
+            'last_player_turn': self.game_player.player_id,
+        }
+
+
+class GameConsumer(GameActionsMixin, WebsocketConsumer):
+    '''
+    It calles desired function whenever an event happens
+    '''
+
+    def send_json(self, content, record=None):
+        if record is None:
+            self.send(**self.codec.encode(content))
             return
-        self.game_player = GamePlayer.objects.get(id=self.game_player.id)
-        cards = self.game_player.cards
-        game_table = self.game_player.game.gametablesnapshot_set.latest(
-            'updated_at')
-        cards_on_table = game_table.cards_on_table
-        next_user = self.get_next_player()
-        if game_table.last_user is not None and game_table.last_user.cards == '0'*game_constants.MAX_CARD_LENGTH:
-            # He is the winner
-            next_user = None
-            Game.objects.filter(id=self.game_player.game.id).update(
-                winner=game_table.last_user.user)
-        cards_played = text_data['cardsPlayed']
-        updated_cards = ""
-        updated_cards_on_table = ""
-        played_card_count = 0
-        for ele in range(len(cards)):
-            if cards_played[ele] == '1':
-                updated_cards += '0'
-                updated_cards_on_table += '1'
-                played_card_count += 1
-            else:
-                updated_cards += cards[ele]
-                updated_cards_on_table += cards_on_table[ele]
-        update_player_serializer = SocketGamePlayerSerializer(
-            self.game_player, data={'cards': updated_cards}, partial=True)
-        update_player_serializer.is_valid(raise_exception=True)
-        update_player_serializer.save()
-        GameTableSnapshot.objects.create(
-            game=self.game_player.game,
-            current_rank=text_data['set'],
-            cards_on_table=updated_cards_on_table,
-            last_cards=cards_played,
-            last_user=self.game_player,
-            current_user=next_user,
-            bluff_caller=None,
-            bluff_successful=None,
-            did_skip=None
-        )
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                'type': 'play_cards',
-                'text': text_data,
-                'action': f"played {played_card_count} card",
-                'last_player_turn': self.game_player.player_id,
-            }
-        )
+        with record.timed('serialize'):
+            frame = self.codec.encode(content)
+        self.send(**frame)
+
+    def group_send(self, event, record):
+        with record.timed('channel'):
+            async_to_sync(self.channel_layer.group_send)(
+                self.room_group_name,
+                event
+            )
+
+    def connect(self):
+        '''
+        initializes gamplayer instance, sends gameState
+        and connects you to the game
+        '''
+        if not self.scope['user'].is_authenticated():
+            self.close()
+            return
+        self.init_room()
+        record = metrics.ActionRecord('connect')
+        with record.tracking():
+            with record.timed('channel'):
+                async_to_sync(self.channel_layer.group_add)(
+                    self.room_group_name,
+                    self.channel_name
+                )
+            self.accept(self.codec.subprotocol)
+            if self.resume_from is not None:
+                messages = self.resume_game(self.scope['user'].id)
+                if messages is not None:
+                    record.action = 'resume'
+                    for message in messages:
+                        self.send_json(message, record)
+                    record.finish()
+                    return
+            try:
+                game_state, event = self.join_game(self.scope['user'].id)
+            except Exception as e:
+                self.game_player = None
+                self.send_json({
+                    'init_success': False,
+                    'message': e.__str__()
+                }, record)
+                self.close()
+                return
+            self.send_json({
+                'init_success': True,
+                **game_state
+            }, record)
+            if event is not None:
+                self.group_send(event, record)
+        record.finish()
+
+    def disconnect(self, close_code):
+        if self.game_player:
+            record = metrics.ActionRecord('disconnect')
+            with record.tracking():
+                event = self.leave_game()
+                if event is not None:
+                    self.group_send(event, record)
+            record.finish()
+            self.close()
 
     def play_cards(self, event):
         '''send data of the game to webSockets'''
-        self.send(text_data=json.dumps({
-            **self.update_game_state(self.scope['user'].id),
-            'bluff_cards': event.get('bluff_cards'),
-            'action': event.get('action'),
-            'last_player_turn': event.get('last_player_turn'),
-            'bluffLooser': event.get('bluffLooser'),
-        }))
+        if self.game_player is None:
+            # Could not join the game
+            return
+        record = metrics.ActionRecord('push')
+        with record.tracking():
+            message = self.push_message(event)
+            if message is not None:
+                self.send_json(message, record)
+        record.finish(log=False)
 
-    def receive(self, text_data):
+    def receive(self, text_data=None, bytes_data=None):
         '''
         performs specified actions
         '''
-        dict_data = json.loads(text_data)
-        if not dict_data.get('action'):
+        dict_data = self.codec.decode(text_data, bytes_data)
+        if not isinstance(dict_data, dict) or not dict_data.get('action'):
+            return
+        private_action = self.private_actions.get(dict_data['action'])
+        if private_action is not None:
+            self.send_json(private_action(dict_data))
             return
-        # Call approriate action
-        self.actions.get(
-            dict_data['action'],
-            lambda: self.send(text_data=json.dumps({
+        action = self.actions.get(dict_data['action'])
+        if action is None:
+            self.send_json({
                 'message': 'Invalid Action'
-            }))
-        )(dict_data)
+            })
+            return
+        record = metrics.ActionRecord(dict_data['action'])
+        with record.tracking():
+            # Call approriate action
+            event = self.perform_action(action, dict_data)
+            if event:
+                self.group_send(event, record)
+        record.finish()
+
+
+class AsyncGameConsumer(GameActionsMixin, AsyncJsonWebsocketConsumer):
+    '''
+    Same protocol as GameConsumer, but channel layer calls run on the
+    event loop and database work of each action runs as a single
+    database_sync_to_async call instead of occupying a thread per socket
+    '''
+
+    async def send_json(self, content, close=False, record=None):
+        if record is None:
+            await self.send(close=close, **self.codec.encode(content))
+            return
+        with record.timed('serialize'):
+            frame = self.codec.encode(content)
+        await self.send(close=close, **frame)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        content = self.codec.decode(text_data, bytes_data)
+        if content is not None:
+            await self.receive_json(content, **kwargs)
+
+    async def group_send(self, event, record):
+        with record.timed('channel'):
+            await self.channel_layer.group_send(self.room_group_name, event)
+
+    async def connect(self):
+        if not self.scope['user'].is_authenticated():
+            await self.close()
+            return
+        self.init_room()
+        record = metrics.ActionRecord('connect')
+        with record.timed('channel'):
+            await self.channel_layer.group_add(
+                self.room_group_name,
+                self.channel_name
+            )
+        await self.accept(self.codec.subprotocol)
+        if self.resume_from is not None:
+            messages = await database_sync_to_async(self.tracked)(
+                record, self.resume_game, self.scope['user'].id)
+            if messages is not None:
+                record.action = 'resume'
+                for message in messages:
+                    await self.send_json(message, record=record)
+                record.finish()
+                return
+        try:
+            game_state, event = await database_sync_to_async(self.tracked)(
+                record, self.join_game, self.scope['user'].id)
+        except Exception as e:
+            self.game_player = None
+            await self.send_json({
+                'init_success': False,
+                'message': e.__str__()
+            }, record=record)
+            await self.close()
+            return
+        await self.send_json({
+            'init_success': True,
+            **game_state
+        }, record=record)
+        if event is not None:
+            await self.group_send(event, record)
+        record.finish()
+
+    async def disconnect(self, close_code):
+        if self.game_player:
+            record = metrics.ActionRecord('disconnect')
+            event = await database_sync_to_async(self.tracked)(
+                record, self.leave_game)
+            if event is not None:
+                await self.group_send(event, record)
+            record.finish()
+        if getattr(self, 'room_group_name', None):
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
+
+    async def play_cards(self, event):
+        '''send data of the game to webSockets'''
+        if self.game_player is None:
+            # Could not join the game
+            return
+        record = metrics.ActionRecord('push')
+        if 'hands' not in event:
+            # Sent by an older consumer, game state has to be read here
+            message = await database_sync_to_async(self.tracked)(
+                record, self.push_message, event)
+        else:
+            with record.timed('serialize'):
+                message = self.push_message(event)
+        if message is not None:
+            await self.send_json(message, record=record)
+        record.finish(log=False)
+
+    async def receive_json(self, content, **kwargs):
+        '''
+        performs specified actions
+        '''
+        if not isinstance(content, dict) or not content.get('action'):
+            return
+        private_action = self.private_actions.get(content['action'])
+        if private_action is not None:
+            await self.send_json(await database_sync_to_async(
+                private_action)(content))
+            return
+        action = self.actions.get(content['action'])
+        if action is None:
+            await self.send_json({
+                'message': 'Invalid Action'
+            })
+            return
+        record = metrics.ActionRecord(content['action'])
+        event = await database_sync_to_async(self.tracked)(
+            record, self.perform_action, action, content)
+        if event:
+            await self.group_send(event, record)
+        record.finish()
+
+
+_drain_registered = False
+
+
+def register_drain():
+    '''
+    Drains games of this worker when it exits, called as it starts
+    serving sockets so that commands and shells importing consumers
+    never drain
+    '''
+    global _drain_registered
+    if not _drain_registered:
+        _drain_registered = True
+        atexit.register(drain_games)
+
+
+def drain_games():
+    '''
+    Disconnects players of every game of this worker as it exits, with
+    one UPDATE and one broadcast per game instead of a transaction and
+    a broadcast per socket, then writes the games
+    Sockets closing meanwhile leave without doing anything
+    '''
+    consumers = {}  # game id -> consumer sending its event
+
+    def leave(state):
+        consumer = consumers[state.game_id] = GameActionsMixin()
+        consumer.room_name = str(state.game_id)
+        consumer.room_group_name = f'game_{consumer.room_name}'
+        return consumer.drain_state(state)
+
+    channel_layer = get_channel_layer()
+    for game_id, event in game_states.drain(leave):
+        if event is None or channel_layer is None:
+            continue
+        try:
+            async_to_sync(channel_layer.group_send)(
+                consumers[game_id].room_group_name, event)
+        except Exception:
+            logger.exception('Could not tell players of game %s', game_id)
+
+
+def resync_players(state):
+    '''
+    Sends the reloaded state of a game to its players, after updates
+    they got were dropped by a conflicting write. The whole state is
+    sent, as the dropped updates are not known to the new epoch
+    '''
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    consumer = GameActionsMixin()
+    consumer.room_name = str(state.game_id)
+    consumer.room_group_name = f'game_{consumer.room_name}'
+    consumer.channel_layer = channel_layer
+    consumer.event_loop = main_event_loop()
+    record = metrics.ActionRecord('resync')
+    event = consumer.publish(state, {'type': 'play_cards', 'action': 'resync'})
+    del event['patch']
+    try:
+        consumer.send_from_timer(event, record)
+    except Exception:
+        logger.exception('Could not resync players of game %s', state.game_id)
+    record.finish()
+
+
+game_states.on_reload = resync_players
@@ -0,0 +1,69 @@
+from django.core import exceptions
+from django.db import models
+
+from apps.game.cards import CardSet, CARD_BYTES
+
+
+class CardSetDescriptor:
+    '''
+    Converts values assigned to the field into CardSet
+    so that instances always expose a CardSet
+    '''
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        if self.field.attname not in instance.__dict__:
+            # Field was deferred
+            instance.refresh_from_db(fields=[self.field.attname])
+        return instance.__dict__[self.field.attname]
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = self.field.to_python(value)
+
+
+class CardSetField(models.BinaryField):
+    '''
+    Stores a CardSet as a packed bitmap of CARD_BYTES bytes
+    Accepts CardSet, packed bytes or '0'/'1' card strings
+    '''
+    description = 'Set of cards packed into a bitmap'
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('max_length', CARD_BYTES)
+        super().__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super().contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.name, CardSetDescriptor(self))
+
+    def from_db_value(self, value, expression, connection, context):
+        if value is None:
+            return value
+        return CardSet.from_bytes(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, CardSet):
+            return value
+        try:
+            if isinstance(value, str):
+                return CardSet.from_string(value)
+            return CardSet.from_bytes(value)
+        except (TypeError, ValueError):
+            raise exceptions.ValidationError(
+                'Invalid cards config', code='invalid')
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = self.to_python(value)
+        if value is None:
+            return None
+        return super().get_db_prep_value(
+            value.to_bytes(), connection, prepared)
+
+    def value_to_string(self, obj):
+        '''Card strings are used while dumping fixtures'''
+        value = self.value_from_object(obj)
+        return value.to_string() if value is not None else None
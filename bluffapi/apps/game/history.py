@@ -0,0 +1,73 @@
+'''
+Move history of games, rebuilt from their checkpoints and events
+Rows are read with iterator() and the table is replayed one version at
+a time, so memory stays the same however long a game is
+'''
+import json
+
+from apps.game.models import GameEvent, GameTableSnapshot
+
+
+def game_history(game):
+    '''
+    Yields details of game followed by a record of every version of it
+    in order, with the move made and the table after it
+    '''
+    players = list(game.gameplayer_set.all())
+    seats = {player.player_id: player for player in players
+             if player.player_id is not None}
+    seat_of = {player.id: player.player_id for player in players}
+    yield {
+        'game': game.id,
+        'decks': game.decks,
+        'started': game.started,
+        'winner': game.winner_id,
+        'players': [{'player_id': seat, 'user': seats[seat].user_id}
+                    for seat in sorted(seats)],
+    }
+    checkpoints = GameTableSnapshot.objects.filter(
+        game=game).order_by('version').iterator()
+    events = GameEvent.objects.filter(
+        game=game).order_by('version').iterator()
+    checkpoint, event = next(checkpoints, None), next(events, None)
+    table = None
+    while checkpoint is not None or event is not None:
+        if event is None or (checkpoint is not None
+                             and checkpoint.version <= event.version):
+            # Stored table wins over replaying the event of its version
+            table, move = checkpoint, None
+            if event is not None and event.version == checkpoint.version:
+                move, event = event, next(events, None)
+            checkpoint = next(checkpoints, None)
+        else:
+            table, move = event.apply(table, seats), event
+            event = next(events, None)
+        yield version_record(table, move, seat_of)
+
+
+def version_record(table, move, seat_of):
+    '''Record of table made by move, players are given by player_id'''
+    played = move is not None and move.cards is not None
+    return {
+        'version': table.version,
+        'action': table.action,
+        'player_id': move.seat if move is not None else None,
+        'cards': move.cards.to_string() if played else None,
+        'rank': move.rank if move is not None else None,
+        'at': (move or table).created_at.isoformat(),
+        'table': {
+            'cards_on_table': table.cards_on_table.to_string(),
+            'last_cards': table.last_cards.to_string(),
+            'current_rank': table.current_rank,
+            'last_player_id': seat_of.get(table.last_user_id),
+            'current_player_id': seat_of.get(table.current_user_id),
+            'bluff_caller_id': seat_of.get(table.bluff_caller_id),
+            'bluff_successful': table.bluff_successful,
+        },
+    }
+
+
+def history_lines(game):
+    '''Yields history of game as newline delimited JSON'''
+    for record in game_history(game):
+        yield json.dumps(record, separators=(',', ':')) + '\n'
@@ -0,0 +1,29 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from apps.game.cards import CardSet, deal
+
+
+class Command(BaseCommand):
+    '''
+    Measures time taken to shuffle and deal cards for every
+    combination of 1-3 decks and 2-9 players
+    '''
+    help = 'Benchmarks dealing of cards at the start of a game'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--runs', type=int, default=1000,
+            help='number of deals measured for every combination')
+
+    def handle(self, *args, **options):
+        runs = options['runs']
+        self.stdout.write(f"{'decks':>5} {'players':>7} {'us/deal':>9}")
+        for decks in range(1, 4):
+            cards = CardSet.full(decks)
+            for players in range(2, 10):
+                seconds = timeit.timeit(
+                    lambda: deal(cards, players), number=runs)
+                self.stdout.write(
+                    f'{decks:>5} {players:>7} {seconds / runs * 1e6:>9.1f}')
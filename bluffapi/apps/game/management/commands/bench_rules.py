@@ -0,0 +1,45 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.game.simulator import SelfPlayGame
+
+
+class Command(BaseCommand):
+    '''
+    Plays random games through apps.game.rules without database or
+    channels and reports moves per second, to measure rule changes
+    '''
+    help = 'Benchmarks the rules engine with random in memory games'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--moves', type=int, default=1000000,
+                            help='no of moves to play, across games')
+        parser.add_argument('--players', type=int, default=4,
+                            help='no of players in every game, 2-9')
+        parser.add_argument('--decks', type=int, default=1,
+                            help='no of decks in every game, 1-3')
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        if not 2 <= options['players'] <= 9:
+            raise CommandError('players must be between 2 and 9')
+        if not 1 <= options['decks'] <= 3:
+            raise CommandError('decks must be between 1 and 3')
+        rng = random.Random(options['seed'])
+        moves = games = abandoned = 0
+        started = time.perf_counter()
+        while moves < options['moves']:
+            game = SelfPlayGame(
+                options['players'], options['decks'], rng, check=False)
+            abandoned += game.play() is None
+            moves += game.moves
+            games += 1
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'{moves} moves in {games} games ({abandoned} abandoned) '
+            f'in {elapsed:.2f}s')
+        self.stdout.write(
+            f'{moves / elapsed:.0f} moves/s, '
+            f'{elapsed / moves * 1e6:.2f} us/move')
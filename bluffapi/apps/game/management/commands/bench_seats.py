@@ -0,0 +1,106 @@
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from apps.accounts.models import User
+from apps.game.models import Game, GamePlayer
+
+
+class Command(BaseCommand):
+    '''
+    Fires concurrent joins at GamePlayer.take_seat on the configured
+    database and reports throughput and latency percentiles of joins,
+    checking that every seat was given out once
+
+    Users and the game created by the run are deleted at the end
+    '''
+    help = 'Benchmarks the seat allocator with concurrent joins'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--joins', type=int, default=500,
+                            help='no of players joining the game')
+        parser.add_argument('--threads', type=int, default=50,
+                            help='no of joins made at the same time')
+        parser.add_argument('--table-size', type=int,
+                            default=settings.TABLE_SIZE,
+                            help='no of seats of the game')
+
+    def handle(self, *args, **options):
+        if options['joins'] < 1 or options['threads'] < 1:
+            raise CommandError('joins and threads must be positive')
+        run_id = uuid.uuid4().hex[:8]
+        try:
+            players = self.create_players(run_id, options['joins'])
+            seats, latencies, elapsed = self.join(
+                players, options['threads'], options['table_size'])
+        finally:
+            User.objects.filter(
+                email__startswith=f'benchseats-{run_id}-').delete()
+        given = sorted(seat for seat in seats if seat is not None)
+        expected = list(range(
+            2, min(options['table_size'], options['joins'] + 1) + 1))
+        if given != expected:
+            raise CommandError(f'Seats {given} were given, not {expected}')
+        latencies.sort()
+        self.stdout.write(
+            f'{len(seats)} joins in {elapsed:.2f}s, '
+            f'{len(seats) / elapsed:.0f} joins/s, {len(given)} seated')
+        self.stdout.write(
+            f'p50 {self.percentile(latencies, 50):.2f} ms, '
+            f'p95 {self.percentile(latencies, 95):.2f} ms, '
+            f'p99 {self.percentile(latencies, 99):.2f} ms')
+
+    def create_players(self, run_id, joins):
+        '''Game of a new owner, who sits first, and joins invited players'''
+        User.objects.bulk_create([
+            User(email=f'benchseats-{run_id}-{i}@example.com',
+                 name=f'bench{i}')
+            for i in range(joins + 1)
+        ])
+        owner, *users = User.objects.filter(
+            email__startswith=f'benchseats-{run_id}-').order_by('id')
+        game = Game.objects.create(owner=owner, seats_taken=1)
+        GamePlayer.objects.bulk_create(
+            [GamePlayer(game=game, user=owner, player_id=1, cards='0' * 156)]
+            + [GamePlayer(game=game, user=user, cards='0' * 156)
+               for user in users])
+        return list(game.gameplayer_set.filter(player_id__isnull=True))
+
+    def join(self, players, thread_count, table_size):
+        '''
+        Seats players from thread_count threads started together
+        Returns seats given, seconds every join took and total seconds
+        '''
+        seats, latencies = [], []
+        barrier = threading.Barrier(thread_count + 1)
+
+        def run(players):
+            try:
+                barrier.wait()
+                for player in players:
+                    started = time.perf_counter()
+                    seat = player.take_seat(table_size)
+                    latencies.append(time.perf_counter() - started)
+                    seats.append(seat)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=run, args=(players[index::thread_count],))
+            for index in range(thread_count)
+        ]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        return seats, latencies, time.perf_counter() - started
+
+    def percentile(self, values, percent):
+        index = max(0, int(round(percent / 100 * len(values))) - 1)
+        return values[index] * 1000
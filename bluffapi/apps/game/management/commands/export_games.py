@@ -0,0 +1,49 @@
+import gzip
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.game.history import history_lines
+from apps.game.models import Game
+
+
+class Command(BaseCommand):
+    '''
+    Writes history of games as newline delimited JSON, the given games
+    to stdout, or with --finished every finished game to its own gzip
+    file for offline analysis
+    '''
+    help = 'Exports move history of games'
+
+    def add_arguments(self, parser):
+        parser.add_argument('game_ids', type=int, nargs='*',
+                            help='games to export, all with --finished')
+        parser.add_argument('--finished', action='store_true',
+                            help='export finished games to gzip files')
+        parser.add_argument('--output', default='.',
+                            help='directory of the gzip files')
+
+    def handle(self, *args, **options):
+        games = Game.objects.order_by('id')
+        if options['game_ids']:
+            games = games.filter(id__in=options['game_ids'])
+        if options['finished']:
+            self.export_finished(games, options['output'])
+            return
+        if not options['game_ids']:
+            raise CommandError('Give game ids or --finished')
+        if games.count() != len(set(options['game_ids'])):
+            raise CommandError('Some games do not exist')
+        for game in games.iterator():
+            for line in history_lines(game):
+                self.stdout.write(line, ending='')
+
+    def export_finished(self, games, output):
+        os.makedirs(output, exist_ok=True)
+        exported = 0
+        for game in games.filter(winner__isnull=False).iterator():
+            path = os.path.join(output, f'game-{game.id}.ndjson.gz')
+            with gzip.open(path, 'wt') as export:
+                export.writelines(history_lines(game))
+            exported += 1
+        self.stdout.write(f'{exported} games exported to {output}')
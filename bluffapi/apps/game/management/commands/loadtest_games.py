@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from types import SimpleNamespace
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+
+from apps.accounts.models import User
+from apps.game.models import GamePlayer
+from apps.game.serializers import CreateGameSerializer
+from apps.game.state import game_states
+
+# Actions every game performs each round, in order
+ROUND_ACTIONS = ('play', 'callBluff', 'play', 'skip')
+IN_MEMORY_LAYER = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {'capacity': 1000},
+    },
+}
+
+
+class QueryCounter(logging.Handler):
+    '''
+    Counts queries logged by django.db.backends from every thread
+    Queries are only logged while DEBUG is on
+    '''
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            self.count += 1
+
+
+class Player:
+    '''A websocket connection of a player along with last state it got'''
+
+    def __init__(self, communicator):
+        self.communicator = communicator
+        self.state = None
+
+    async def receive(self, timeout):
+        '''Returns next message or None when nothing came within timeout'''
+        if await self.communicator.receive_nothing(timeout, interval=0.001):
+            return None
+        self.state = json.loads(await self.communicator.receive_from())
+        return self.state
+
+    async def drain(self, timeout=0.05):
+        while await self.receive(timeout) is not None:
+            pass
+
+
+class LoadGame:
+    '''Drives one game through the websocket application'''
+
+    def __init__(self, command, game, users):
+        self.command = command
+        self.game = game
+        self.users = users
+        self.players = {}  # player_id -> Player
+        self.finished = False
+
+    async def connect(self, path):
+        for user in self.users:
+            communicator = WebsocketCommunicator(
+                self.command.application, f'{path}{self.game.id}/',
+                headers=[(b'cookie', bytes(
+                    f'token={user.auth_token.key}', 'utf-8'))])
+            started = time.perf_counter()
+            connected, subprotocol = await communicator.connect()
+            player = Player(communicator)
+            message = await player.receive(self.command.timeout)
+            self.command.record('connect', started)
+            if not connected or not message or not message['init_success']:
+                raise CommandError(f'Could not connect to game {self.game.id}')
+            self.players[message['self']['player_id']] = player
+        for player in self.players.values():
+            await player.drain()
+
+    async def act(self, action, player, data=None):
+        '''
+        Sends action of player and waits till every player gets its update
+        Latency is measured until the acting player gets the update
+        '''
+        started = time.perf_counter()
+        await player.communicator.send_json_to({'action': action, **(data or {})})
+        if await player.receive(self.command.timeout) is None:
+            # Action was refused or game is over
+            self.command.failures[action] += 1
+            self.finished = True
+            return
+        self.command.record(action, started)
+        for other in self.players.values():
+            if other is not player and \
+                    await other.receive(self.command.timeout) is None:
+                self.command.failures[action] += 1
+        if player.state['game']['winner'] is not None:
+            self.finished = True
+
+    @property
+    def current_player(self):
+        any_player = next(iter(self.players.values()))
+        player_id = any_player.state['game_table']['current_player_id']
+        return self.players.get(player_id)
+
+    async def start(self):
+        await self.act('start', self.players[1])
+
+    async def step(self, action):
+        if self.finished:
+            return
+        player = self.current_player
+        if player is None:
+            self.finished = True
+            return
+        if action == 'play':
+            cards = player.state['self']['cards']
+            held = [index for index, card in enumerate(cards) if card == '1']
+            if not held:
+                self.finished = True
+                return
+            index = random.choice(held)
+            played = ['0'] * len(cards)
+            played[index] = '1'
+            # Claim the real rank of the card half of the times
+            rank = index // 12 + 1 if random.random() < 0.5 \
+                else random.randint(1, 13)
+            await self.act(action, player, {
+                'cardsPlayed': ''.join(played), 'set': rank})
+        else:
+            await self.act(action, player)
+
+    async def disconnect(self):
+        for player in self.players.values():
+            started = time.perf_counter()
+            await player.communicator.disconnect()
+            self.command.record('disconnect', started)
+
+
+class Command(BaseCommand):
+    '''
+    Plays concurrent games through bluffapi.routing.application over the
+    in memory channel layer and the configured database, then reports
+    throughput, latency percentiles and queries of every action
+
+    Users and games created by the run are deleted at the end
+    '''
+    help = 'Load tests the game websocket with concurrent games'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=10,
+                            help='no of concurrent games')
+        parser.add_argument('--players', type=int, default=4,
+                            help='no of players in every game, 2 to TABLE_SIZE')
+        parser.add_argument('--decks', type=int, default=1,
+                            help='no of decks in every game, 1-3')
+        parser.add_argument('--rounds', type=int, default=5,
+                            help=f'no of times every game plays {ROUND_ACTIONS}')
+        parser.add_argument('--consumer', choices=['sync', 'async'],
+                            default='sync', help='game consumer to use')
+        parser.add_argument('--timeout', type=float, default=10,
+                            help='seconds to wait for a reply')
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        if not 2 <= options['players'] <= settings.TABLE_SIZE:
+            raise CommandError(
+                f'players must be between 2 and {settings.TABLE_SIZE}')
+        if not 1 <= options['decks'] <= 3:
+            raise CommandError('decks must be between 1 and 3')
+        random.seed(options['seed'])
+        self.timeout = options['timeout']
+        self.latencies = defaultdict(list)  # action -> seconds
+        self.queries = defaultdict(int)  # action -> queries
+        self.failures = defaultdict(int)
+        self.query_counter = QueryCounter()
+        run_id = uuid.uuid4().hex[:8]
+
+        db_logger = logging.getLogger('django.db.backends')
+        old_level = db_logger.level
+        db_logger.setLevel(logging.DEBUG)
+        db_logger.addHandler(self.query_counter)
+        # A log line per action would flood the report
+        metrics_logger = logging.getLogger('apps.game.metrics')
+        old_metrics_level = metrics_logger.level
+        metrics_logger.setLevel(logging.WARNING)
+        try:
+            # Players leave right away so that the run can flush them
+            with override_settings(DEBUG=True,
+                                   CHANNEL_LAYERS=IN_MEMORY_LAYER,
+                                   DISCONNECT_GRACE_PERIOD=0,
+                                   TURN_TIMEOUT=0):
+                from bluffapi.routing import application
+                self.application = application
+                games = self.create_games(run_id, options)
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                try:
+                    elapsed = loop.run_until_complete(self.run(
+                        games, options['rounds'],
+                        f"ws/game/{options['consumer']}/"))
+                finally:
+                    loop.close()
+                before = self.query_counter.count
+                game_states.flush_all()
+                self.queries['flush'] += self.query_counter.count - before
+        finally:
+            db_logger.removeHandler(self.query_counter)
+            db_logger.setLevel(old_level)
+            metrics_logger.setLevel(old_metrics_level)
+            User.objects.filter(email__startswith=f'loadtest-{run_id}-').delete()
+        self.report(elapsed)
+
+    def create_games(self, run_id, options):
+        games = []
+        for game_number in range(options['games']):
+            users = [
+                User.objects.create(
+                    email=f'loadtest-{run_id}-{game_number}-{i}@example.com',
+                    name=f'load{game_number}-{i}')
+                for i in range(options['players'])
+            ]
+            for user in users:
+                Token.objects.create(user=user)
+            serializer = CreateGameSerializer(
+                data={'decks': options['decks']},
+                context={'request': SimpleNamespace(user=users[0])})
+            serializer.is_valid(raise_exception=True)
+            game = serializer.save()
+            GamePlayer.objects.bulk_create([
+                GamePlayer(user=user, game=game, cards='0' * 156)
+                for user in users[1:]
+            ])
+            users = list(User.objects.select_related('auth_token').filter(
+                id__in=[user.id for user in users]).order_by('id'))
+            games.append(LoadGame(self, game, users))
+        return games
+
+    async def phase(self, name, coroutines):
+        '''Runs coroutines concurrently and counts queries made meanwhile'''
+        before = self.query_counter.count
+        await asyncio.gather(*coroutines)
+        self.queries[name] += self.query_counter.count - before
+
+    async def run(self, games, rounds, path):
+        started = time.perf_counter()
+        await self.phase('connect', [game.connect(path) for game in games])
+        await self.phase('start', [game.start() for game in games])
+        for round_number in range(rounds):
+            for action in ROUND_ACTIONS:
+                await self.phase(action, [game.step(action) for game in games])
+        await self.phase('disconnect', [game.disconnect() for game in games])
+        return time.perf_counter() - started
+
+    def record(self, action, started):
+        self.latencies[action].append(time.perf_counter() - started)
+
+    def percentile(self, values, percent):
+        index = max(0, int(round(percent / 100 * len(values))) - 1)
+        return values[index] * 1000
+
+    def report(self, elapsed):
+        total = sum(len(values) for values in self.latencies.values())
+        self.stdout.write(
+            f'{total} actions in {elapsed:.2f}s, {total / elapsed:.1f} actions/s')
+        self.stdout.write(
+            f"{'action':<12}{'count':>7}{'p50 ms':>9}{'p95 ms':>9}"
+            f"{'p99 ms':>9}{'queries':>9}{'failed':>8}")
+        for action in ('connect', 'start') + tuple(
+                dict.fromkeys(ROUND_ACTIONS)) + ('disconnect',):
+            values = sorted(self.latencies[action])
+            if not values:
+                continue
+            self.stdout.write(
+                f'{action:<12}{len(values):>7}'
+                f'{self.percentile(values, 50):>9.2f}'
+                f'{self.percentile(values, 95):>9.2f}'
+                f'{self.percentile(values, 99):>9.2f}'
+                f'{self.queries[action] / len(values):>9.2f}'
+                f'{self.failures[action]:>8}')
+        self.stdout.write(f"queries while flushing at exit: {self.queries['flush']}")
@@ -0,0 +1,74 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.game.simulator import InvariantViolation, SelfPlayGame
+
+
+class Command(BaseCommand):
+    '''
+    Plays bot versus bot games in memory for every combination of the
+    given decks and player counts, checking invariants after every move
+    Reports throughput and the seed of every game breaking an invariant,
+    which replays it with --seed and --games 1
+    '''
+    help = 'Fuzzes the game rules with self play games'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=1000,
+                            help='no of games of every combination')
+        parser.add_argument('--players', type=int, nargs='+',
+                            default=list(range(2, 10)),
+                            help='player counts to play with, 2-9')
+        parser.add_argument('--decks', type=int, nargs='+',
+                            default=[1, 2, 3], help='decks to play with, 1-3')
+        parser.add_argument('--disconnect-rate', type=float, default=0.01,
+                            help='chance of a player dropping or coming '
+                            'back before a move')
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        if not all(2 <= players <= 9 for players in options['players']):
+            raise CommandError('players must be between 2 and 9')
+        if not all(1 <= decks <= 3 for decks in options['decks']):
+            raise CommandError('decks must be between 1 and 3')
+        seeds = random.Random(options['seed'])
+        failures = 0
+        total_games = total_moves = 0
+        started = time.perf_counter()
+        self.stdout.write(
+            f"{'decks':>5} {'players':>7} {'games/s':>9} {'moves/s':>9}"
+            f"{'abandoned':>10}{'failed':>7}")
+        for decks in options['decks']:
+            for players in options['players']:
+                games = moves = abandoned = failed = 0
+                combination_started = time.perf_counter()
+                for game_number in range(options['games']):
+                    seed = seeds.randrange(2 ** 32)
+                    game = SelfPlayGame(
+                        players, decks, random.Random(seed),
+                        disconnect_rate=options['disconnect_rate'])
+                    try:
+                        abandoned += game.play() is None
+                    except InvariantViolation as e:
+                        failed += 1
+                        self.stderr.write(
+                            f'decks={decks} players={players} seed={seed} '
+                            f'move {game.moves}: {e}')
+                    games += 1
+                    moves += game.moves
+                elapsed = time.perf_counter() - combination_started
+                self.stdout.write(
+                    f'{decks:>5} {players:>7} {games / elapsed:>9.0f} '
+                    f'{moves / elapsed:>9.0f}{abandoned:>10}{failed:>7}')
+                total_games += games
+                total_moves += moves
+                failures += failed
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'{total_games} games, {total_moves} moves in {elapsed:.2f}s: '
+            f'{total_games / elapsed:.1f} games/s, '
+            f'{total_moves / elapsed:.0f} moves/s')
+        if failures:
+            raise CommandError(f'{failures} games broke an invariant')
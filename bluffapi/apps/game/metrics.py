@@ -0,0 +1,216 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+
+logger = logging.getLogger(__name__)
+
+MS_BUCKETS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# metric name -> (buckets, description)
+METRICS = {
+    'duration_ms': (MS_BUCKETS, 'time taken by the action'),
+    'queries': (QUERY_BUCKETS, 'no of sql queries made by the action'),
+    'db_ms': (MS_BUCKETS, 'time spent in sql queries'),
+    'serialize_ms': (MS_BUCKETS, 'time spent serializing game state'),
+    'channel_ms': (MS_BUCKETS, 'time spent sending to the channel layer'),
+}
+
+_local = threading.local()
+
+
+class Histogram:
+    '''
+    Cumulative histogram with fixed bucket upper bounds
+    '''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        '''Returns (cumulative counts per bucket, sum, count)'''
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = []
+        running = 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+class MetricsRegistry:
+    '''
+    Histograms of every metric of every action of this process
+    '''
+
+    def __init__(self):
+        self._histograms = {}  # (metric, action) -> Histogram
+        self._lock = threading.Lock()
+
+    def observe(self, metric, action, value):
+        key = (metric, action)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(
+                    key, Histogram(METRICS[metric][0]))
+        histogram.observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._histograms = {}
+
+    def render(self):
+        '''Returns histograms in prometheus text format'''
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        lines = []
+        by_metric = defaultdict(list)
+        for (metric, action), histogram in histograms:
+            by_metric[metric].append((action, histogram))
+        for metric, actions in by_metric.items():
+            name = f'game_action_{metric}'
+            lines.append(f'# HELP {name} {METRICS[metric][1]}')
+            lines.append(f'# TYPE {name} histogram')
+            for action, histogram in actions:
+                cumulative, total, count = histogram.snapshot()
+                bounds = [str(bucket) for bucket in histogram.buckets]
+                for bound, bucket_count in zip(bounds + ['+Inf'], cumulative):
+                    lines.append(
+                        f'{name}_bucket{{action="{action}",le="{bound}"}} '
+                        f'{bucket_count}')
+                lines.append(f'{name}_sum{{action="{action}"}} {total:g}')
+                lines.append(f'{name}_count{{action="{action}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+action_metrics = MetricsRegistry()
+
+
+class CountingCursorWrapper(CursorWrapper):
+    '''
+    Adds every query of the cursor and time taken by it to record
+    '''
+
+    def __init__(self, cursor, db, record):
+        super().__init__(cursor, db)
+        self.record = record
+
+    def execute(self, sql, params=None):
+        with self.record.query():
+            return super().execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        with self.record.query():
+            return super().executemany(sql, param_list)
+
+
+def _count_queries(db):
+    '''
+    Makes cursors of db, the connection of this thread, count queries
+    into the current record, cursors made outside of actions are left
+    as they are
+    '''
+    if getattr(db, 'counting_queries', False):
+        return
+
+    def counting(make_cursor):
+        def wrapper(cursor):
+            cursor = make_cursor(cursor)
+            record = getattr(_local, 'record', None)
+            if record is None:
+                return cursor
+            return CountingCursorWrapper(cursor, cursor.db, record)
+        return wrapper
+
+    db.make_cursor = counting(db.make_cursor)
+    db.make_debug_cursor = counting(db.make_debug_cursor)
+    db.counting_queries = True
+
+
+class ActionRecord:
+    '''
+    Costs of one websocket action
+    Queries are counted by cursors of the threads which run the action
+    inside tracking(), so the debug cursor and its log stay off
+    '''
+
+    def __init__(self, action):
+        self.action = action
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.timings = defaultdict(float)  # part -> seconds
+
+    @contextmanager
+    def timed(self, part):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[part] += time.perf_counter() - started
+
+    @contextmanager
+    def tracking(self):
+        '''Counts queries made by this thread and makes self current'''
+        _count_queries(connection)
+        previous, _local.record = getattr(_local, 'record', None), self
+        try:
+            yield self
+        finally:
+            _local.record = previous
+
+    @contextmanager
+    def query(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.queries += 1
+            self.timings['db'] += time.perf_counter() - started
+
+    def finish(self, log=True):
+        '''Adds the record to histograms and logs it'''
+        duration_ms = (time.perf_counter() - self.started) * 1000
+        values = {
+            'duration_ms': duration_ms,
+            'queries': self.queries,
+            'db_ms': self.timings['db'] * 1000,
+            'serialize_ms': self.timings['serialize'] * 1000,
+            'channel_ms': self.timings['channel'] * 1000,
+        }
+        for metric, value in values.items():
+            action_metrics.observe(metric, self.action, value)
+        if log:
+            logger.info(
+                'game_action action=%s duration_ms=%.2f queries=%d db_ms=%.2f '
+                'serialize_ms=%.2f channel_ms=%.2f', self.action,
+                duration_ms, self.queries, values['db_ms'],
+                values['serialize_ms'], values['channel_ms'],
+                extra={'game_action': {'action': self.action, **values}})
+
+
+@contextmanager
+def timed(part):
+    '''Adds time taken by the block to the record of the current thread'''
+    record = getattr(_local, 'record', None)
+    if record is None:
+        yield
+        return
+    with record.timed(part):
+        yield
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import apps.game.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0013_auto_20201018_1908'),
+    ]
+
+    operations = [
+        # Card strings are made nullable so that they can be dropped
+        # and restored while unapplying
+        migrations.AlterField(
+            model_name='gameplayer',
+            name='cards',
+            field=models.CharField(help_text='string of length max_decks*52 where 1 is represented by card that user have', max_length=156, null=True),
+        ),
+        migrations.AlterField(
+            model_name='gametablesnapshot',
+            name='cards_on_table',
+            field=models.CharField(help_text='string of length max_decks*52 where 1 is represented by card on table', max_length=156, null=True),
+        ),
+        migrations.AlterField(
+            model_name='gametablesnapshot',
+            name='last_cards',
+            field=models.CharField(help_text='string of length max_decks*52 which represents last cards that were played', max_length=156, null=True),
+        ),
+        migrations.AddField(
+            model_name='gameplayer',
+            name='packed_cards',
+            field=apps.game.fields.CardSetField(max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='gametablesnapshot',
+            name='packed_cards_on_table',
+            field=apps.game.fields.CardSetField(max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='gametablesnapshot',
+            name='packed_last_cards',
+            field=apps.game.fields.CardSetField(max_length=20, null=True),
+        ),
+    ]
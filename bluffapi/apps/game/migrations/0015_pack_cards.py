@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from apps.game import constants as game_constants
+from apps.game.cards import CardSet
+
+
+def to_card_set(cards):
+    '''Converts old card strings, empty or malformed strings become no cards'''
+    if len(cards or '') != game_constants.MAX_CARD_LENGTH:
+        return CardSet()
+    return CardSet.from_string(cards)
+
+
+def update_rows(schema_editor, model, fields, rows, batch_size=1000):
+    '''
+    Sets fields of every (id, *values) of rows, an executemany of
+    batch_size rows at a time
+    '''
+    connection = schema_editor.connection
+    fields = [model._meta.get_field(name) for name in fields]
+    qn = schema_editor.quote_name
+    sql = 'UPDATE {} SET {} WHERE id = %s'.format(
+        qn(model._meta.db_table),
+        ', '.join('{} = %s'.format(qn(field.column)) for field in fields))
+    with connection.cursor() as cursor:
+        batch = []
+        for row_id, *values in rows:
+            batch.append([
+                field.get_db_prep_value(value, connection)
+                for field, value in zip(fields, values)] + [row_id])
+            if len(batch) == batch_size:
+                cursor.executemany(sql, batch)
+                batch = []
+        if batch:
+            cursor.executemany(sql, batch)
+
+
+def pack_cards(apps, schema_editor):
+    GamePlayer = apps.get_model('game', 'GamePlayer')
+    GameTableSnapshot = apps.get_model('game', 'GameTableSnapshot')
+    update_rows(schema_editor, GamePlayer, ['packed_cards'], (
+        (player_id, to_card_set(cards))
+        for player_id, cards in GamePlayer.objects.values_list(
+            'id', 'cards').iterator()))
+    update_rows(
+        schema_editor, GameTableSnapshot,
+        ['packed_cards_on_table', 'packed_last_cards'], (
+            (snapshot_id, to_card_set(on_table), to_card_set(last))
+            for snapshot_id, on_table, last in
+            GameTableSnapshot.objects.values_list(
+                'id', 'cards_on_table', 'last_cards').iterator()))
+
+
+def unpack_cards(apps, schema_editor):
+    GamePlayer = apps.get_model('game', 'GamePlayer')
+    GameTableSnapshot = apps.get_model('game', 'GameTableSnapshot')
+    update_rows(schema_editor, GamePlayer, ['cards'], (
+        (player_id, (cards or CardSet()).to_string())
+        for player_id, cards in GamePlayer.objects.values_list(
+            'id', 'packed_cards').iterator()))
+    update_rows(
+        schema_editor, GameTableSnapshot, ['cards_on_table', 'last_cards'], (
+            (snapshot_id, (on_table or CardSet()).to_string(),
+             (last or CardSet()).to_string())
+            for snapshot_id, on_table, last in
+            GameTableSnapshot.objects.values_list(
+                'id', 'packed_cards_on_table', 'packed_last_cards'
+            ).iterator()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0014_cardset_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(pack_cards, unpack_cards),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import apps.game.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0015_pack_cards'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='gameplayer',
+            name='cards',
+        ),
+        migrations.RemoveField(
+            model_name='gametablesnapshot',
+            name='cards_on_table',
+        ),
+        migrations.RemoveField(
+            model_name='gametablesnapshot',
+            name='last_cards',
+        ),
+        migrations.RenameField(
+            model_name='gameplayer',
+            old_name='packed_cards',
+            new_name='cards',
+        ),
+        migrations.RenameField(
+            model_name='gametablesnapshot',
+            old_name='packed_cards_on_table',
+            new_name='cards_on_table',
+        ),
+        migrations.RenameField(
+            model_name='gametablesnapshot',
+            old_name='packed_last_cards',
+            new_name='last_cards',
+        ),
+        migrations.AlterField(
+            model_name='gameplayer',
+            name='cards',
+            field=apps.game.fields.CardSetField(help_text='bitmap of max_decks*52 cards where set bit represents card that user have', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='gametablesnapshot',
+            name='cards_on_table',
+            field=apps.game.fields.CardSetField(help_text='bitmap of max_decks*52 cards where set bit represents card on table', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='gametablesnapshot',
+            name='last_cards',
+            field=apps.game.fields.CardSetField(help_text='bitmap of max_decks*52 cards which represents last cards that were played', max_length=20),
+        ),
+    ]
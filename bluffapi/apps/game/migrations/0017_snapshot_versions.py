@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.17 on 2026-10-18 11:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def number_snapshots(apps, schema_editor):
+    '''
+    Numbers snapshots of every game in the order they were made, with
+    one UPDATE for all of them
+    '''
+    qn = schema_editor.quote_name
+    table = qn(apps.get_model('game', 'GameTableSnapshot')._meta.db_table)
+    if schema_editor.connection.vendor == 'postgresql':
+        sql = f'''
+            UPDATE {table} SET version = numbered.version
+            FROM (
+                SELECT id, row_number() OVER (
+                    PARTITION BY game_id ORDER BY updated_at, id) AS version
+                FROM {table}
+            ) AS numbered
+            WHERE {table}.id = numbered.id
+        '''
+    else:
+        sql = f'''
+            UPDATE {table} SET version = (
+                SELECT count(*) FROM {table} earlier
+                WHERE earlier.game_id = {table}.game_id
+                AND (earlier.updated_at < {table}.updated_at
+                     OR (earlier.updated_at = {table}.updated_at
+                         AND earlier.id <= {table}.id))
+            )
+        '''
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0016_replace_card_strings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gametablesnapshot',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='position of the snapshot in its game'),
+        ),
+        migrations.AddField(
+            model_name='gametablesnapshot',
+            name='action',
+            field=models.CharField(blank=True, choices=[('create', 'create'), ('join', 'join'), ('start', 'start'), ('play', 'play'), ('callBluff', 'callBluff'), ('skip', 'skip')], help_text='action which made the snapshot', max_length=16),
+        ),
+        migrations.RunPython(number_snapshots, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='gametablesnapshot',
+            unique_together=set([('game', 'version')]),
+        ),
+    ]
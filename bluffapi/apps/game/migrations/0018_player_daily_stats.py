@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.17 on 2026-10-18 11:35
+from __future__ import unicode_literals
+
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+from apps.game.cards import CardSet
+
+
+def build_stats(apps, schema_editor):
+    '''
+    Builds stats from finished games and bluffs called so far
+    A called bluff was successful when the last cards played were not
+    all of the claimed rank, as decided live by rules.call_bluff. They
+    are read from the snapshot before the call, as bluff_successful was
+    stored as True for every call and the turn goes to nobody after a
+    call which ends the game
+    '''
+    Game = apps.get_model('game', 'Game')
+    GamePlayer = apps.get_model('game', 'GamePlayer')
+    GameTableSnapshot = apps.get_model('game', 'GameTableSnapshot')
+    PlayerDailyStats = apps.get_model('game', 'PlayerDailyStats')
+    stats = defaultdict(Counter)
+    finished_games = Game.objects.filter(winner__isnull=False)
+    for user_id, updated_at in GamePlayer.objects.filter(
+            game__in=finished_games, player_id__isnull=False
+    ).values_list('user_id', 'game__updated_at').iterator():
+        stats[user_id, timezone.localdate(updated_at)]['games_played'] += 1
+    previous = None  # (game id, last cards, current rank) of last snapshot
+    for game_id, user_id, last_cards, current_rank, created_at in \
+            GameTableSnapshot.objects.order_by('game', 'version').values_list(
+                'game_id', 'bluff_caller__user_id', 'last_cards',
+                'current_rank', 'created_at').iterator():
+        if user_id is not None and previous is not None \
+                and previous[0] == game_id:
+            counts = stats[user_id, timezone.localdate(created_at)]
+            counts['bluffs_called'] += 1
+            if (previous[1] or CardSet()).from_rank(previous[2]):
+                counts['bluffs_failed'] += 1
+            else:
+                counts['bluffs_successful'] += 1
+        previous = game_id, last_cards, current_rank
+    PlayerDailyStats.objects.bulk_create([
+        PlayerDailyStats(user_id=user_id, day=day, **counts)
+        for (user_id, day), counts in stats.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('game', '0017_snapshot_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayerDailyStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('day', models.DateField(help_text='day on which the actions happened')),
+                ('bluffs_called', models.PositiveIntegerField(default=0, help_text='no of times user called bluff')),
+                ('bluffs_successful', models.PositiveIntegerField(default=0, help_text='no of called bluffs which were bluffs')),
+                ('bluffs_failed', models.PositiveIntegerField(default=0, help_text='no of called bluffs which were not bluffs')),
+                ('games_played', models.PositiveIntegerField(default=0, help_text='no of games finished by user')),
+                ('user', models.ForeignKey(help_text='user whose stats are stored', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='playerdailystats',
+            unique_together=set([('user', 'day')]),
+        ),
+        migrations.RunPython(build_stats, migrations.RunPython.noop),
+    ]
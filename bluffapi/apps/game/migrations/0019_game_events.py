@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.17 on 2026-10-18 12:02
+from __future__ import unicode_literals
+
+import apps.game.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0018_player_daily_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(help_text='version of the game made by the event')),
+                ('action', models.CharField(choices=[('create', 'create'), ('join', 'join'), ('start', 'start'), ('play', 'play'), ('callBluff', 'callBluff'), ('skip', 'skip')], help_text='move made by the player', max_length=16)),
+                ('seat', models.PositiveSmallIntegerField(help_text='player_id of the player who made the move')),
+                ('cards', apps.game.fields.CardSetField(help_text='bitmap of cards played, only for play', max_length=20, null=True)),
+                ('rank', models.PositiveSmallIntegerField(help_text='rank claimed for cards played, only for play', null=True)),
+                ('next_seat', models.PositiveSmallIntegerField(help_text='player_id of the player in turn after the move', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('game', models.ForeignKey(help_text='instance of the game', on_delete=django.db.models.deletion.CASCADE, to='game.Game')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='gameevent',
+            unique_together=set([('game', 'version')]),
+        ),
+    ]
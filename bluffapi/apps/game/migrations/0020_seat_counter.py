@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.17 on 2026-10-18 12:07
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def repair_seats(apps, schema_editor):
+    '''
+    Moves players sharing a seat, left by concurrent joins, to seats
+    after the last one of their game
+    '''
+    GamePlayer = apps.get_model('game', 'GamePlayer')
+    games = {
+        row['game'] for row in GamePlayer.objects.filter(
+            player_id__isnull=False).values('game', 'player_id').annotate(
+            players=Count('id')).filter(players__gt=1)
+    }
+    for game_id in games:
+        seats = GamePlayer.objects.filter(
+            game_id=game_id, player_id__isnull=False).order_by('player_id', 'id')
+        last_seat = seats.aggregate(Max('player_id'))['player_id__max']
+        taken = set()
+        for player_id, seat in seats.values_list('id', 'player_id'):
+            if seat in taken:
+                last_seat += 1
+                GamePlayer.objects.filter(id=player_id).update(
+                    player_id=last_seat)
+            taken.add(seat)
+
+
+def count_seats(apps, schema_editor):
+    '''Starts seat counter of every game after its highest player_id'''
+    Game = apps.get_model('game', 'Game')
+    GamePlayer = apps.get_model('game', 'GamePlayer')
+    for row in GamePlayer.objects.filter(player_id__isnull=False).values(
+            'game').annotate(seats_taken=Max('player_id')):
+        Game.objects.filter(id=row['game']).update(
+            seats_taken=row['seats_taken'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('game', '0019_game_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='seats_taken',
+            field=models.PositiveIntegerField(default=0, help_text='no of player_ids given out, the next player gets the next one'),
+        ),
+        migrations.RunPython(repair_seats, migrations.RunPython.noop),
+        migrations.RunPython(count_seats, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='gameplayer',
+            unique_together=set([('user', 'game'), ('game', 'player_id')]),
+        ),
+    ]
@@ -1,8 +1,10 @@
-from django.db import models
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import F
 
 from apps.accounts import models as accounts_models
 from apps.common import models as common_models
-from apps.game import constants as game_constants
+from apps.game import constants as game_constants, fields as game_fields
+from apps.game.cards import CardSet
 
 
 class Game(common_models.TimeStampModel):
@@ -23,10 +25,34 @@ class Game(common_models.TimeStampModel):
     )
     owner = models.ForeignKey(accounts_models.User,
                               on_delete=models.CASCADE, related_name='owner', help_text='user which is the owner of this game')
+    seats_taken = models.PositiveIntegerField(
+        default=0, help_text='no of player_ids given out, the next player gets the next one')
 
     def __str__(self):
         return f'{self.owner.name}({self.id})'
 
+    def get_current_snapshot(self, players=None):
+        '''
+        Returns current GameTableSnapshot of the game, made by replaying
+        events after the latest checkpoint, unsaved when events were
+        replayed. players are the GamePlayers of the game when known
+        '''
+        checkpoint = self.gametablesnapshot_set.order_by('-version').first()
+        if checkpoint is None:
+            return None
+        events = list(self.gameevent_set.filter(
+            version__gt=checkpoint.version).order_by('version'))
+        if not events:
+            return checkpoint
+        if players is None:
+            players = self.gameplayer_set.all()
+        seats = {player.player_id: player for player in players
+                 if player.player_id is not None}
+        table = checkpoint
+        for event in events:
+            table = event.apply(table, seats)
+        return table
+
 
 class GamePlayer(common_models.TimeStampModel):
     '''
@@ -42,29 +68,118 @@ class GamePlayer(common_models.TimeStampModel):
         default=True, help_text='tells if player is disconnected')
     no_action = models.PositiveIntegerField(
         default=0, help_text='no of times no action is performed')
-    cards = models.CharField(
-        max_length=game_constants.MAX_CARD_LENGTH, help_text='string of length max_decks*52 where 1 is represented by card that user have')
+    cards = game_fields.CardSetField(
+        help_text='bitmap of max_decks*52 cards where set bit represents card that user have')
 
     class Meta:
-        unique_together = ('user', 'game')
+        unique_together = (('user', 'game'), ('game', 'player_id'))
 
     def __str__(self):
         return f"{self.user.name} {self.game.id}"
 
+    def take_seat(self, table_size):
+        '''
+        Gives the next player_id of the game to the player and marks him
+        connected, unless he is seated already or table_size players are
+        seated. On postgres it is one statement, a conditional UPDATE of
+        the seat counter of the game whose RETURNING seats the player,
+        which keeps the game locked till the seat is written, so
+        concurrent joins get distinct seats in O(1)
+        Returns player_id of the player, None when the table is full
+        '''
+        while True:
+            with transaction.atomic():
+                if connection.vendor == 'postgresql':
+                    taken, seated, current = self._claim_seat_returning(
+                        table_size)
+                else:
+                    taken, seated, current = self._claim_seat(table_size)
+                if taken is not None and seated is None:
+                    # Seated by another connection meanwhile, give the seat
+                    # back and find his seat on the next pass
+                    transaction.set_rollback(True)
+                    continue
+            if seated is not None:
+                self.disconnected = False
+            self.player_id = seated if seated is not None else current
+            return self.player_id
+
+    def _claim_seat_returning(self, table_size):
+        '''
+        Returns seat counter after taking a seat, seat given to the player
+        and his seat before, None for what did not happen
+        '''
+        qn = connection.ops.quote_name
+        game, player = qn(Game._meta.db_table), qn(GamePlayer._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                WITH seat AS (
+                    UPDATE {game} SET seats_taken = seats_taken + 1
+                    WHERE id = %(game)s AND seats_taken < %(table_size)s
+                    AND EXISTS (SELECT 1 FROM {player}
+                                WHERE id = %(player)s AND player_id IS NULL)
+                    RETURNING seats_taken
+                ), seated AS (
+                    UPDATE {player} SET player_id = seat.seats_taken,
+                        disconnected = false
+                    FROM seat
+                    WHERE {player}.id = %(player)s
+                    AND {player}.player_id IS NULL
+                    RETURNING {player}.player_id
+                )
+                SELECT (SELECT seats_taken FROM seat),
+                       (SELECT player_id FROM seated),
+                       (SELECT player_id FROM {player} WHERE id = %(player)s)
+            ''', {'game': self.game_id, 'table_size': table_size,
+                  'player': self.id})
+            return cursor.fetchone()
+
+    def _claim_seat(self, table_size):
+        '''
+        _claim_seat_returning for databases without data modifying CTEs,
+        the counter is still updated first so that the game stays locked
+        '''
+        if not Game.objects.filter(
+                id=self.game_id, seats_taken__lt=table_size,
+                gameplayer__id=self.id, gameplayer__player_id__isnull=True
+        ).update(seats_taken=F('seats_taken') + 1):
+            return None, None, GamePlayer.objects.values_list(
+                'player_id', flat=True).get(id=self.id)
+        taken = Game.objects.values_list(
+            'seats_taken', flat=True).get(id=self.game_id)
+        seated = GamePlayer.objects.filter(
+            id=self.id, player_id__isnull=True
+        ).update(player_id=taken, disconnected=False)
+        return taken, taken if seated else None, None
+
 
 class GameTableSnapshot(common_models.TimeStampModel):
     '''
     Model to store the state of gameTable
     All cards are on Table untill Game has started
+
+    Snapshots are never updated, every change of the table makes the
+    next version of the game, unique versions make concurrent appends
+    of the same version fail. Moves are stored as GameEvents and only
+    every CHECKPOINT_INTERVAL-th version is stored as a snapshot too
     '''
+    ACTIONS = (
+        ('create', 'create'),
+        ('join', 'join'),
+        ('start', 'start'),
+        ('play', 'play'),
+        ('callBluff', 'callBluff'),
+        ('skip', 'skip'),
+    )
+
     game = models.ForeignKey(
         Game, on_delete=models.CASCADE, help_text='instance of the game')
     current_rank = models.PositiveIntegerField(
         null=True, blank=True, help_text='current_rank from 1-13')
-    cards_on_table = models.CharField(
-        max_length=game_constants.MAX_CARD_LENGTH, help_text='string of length max_decks*52 where 1 is represented by card on table')
-    last_cards = models.CharField(
-        max_length=game_constants.MAX_CARD_LENGTH, help_text='string of length max_decks*52 which represents last cards that were played')
+    cards_on_table = game_fields.CardSetField(
+        help_text='bitmap of max_decks*52 cards where set bit represents card on table')
+    last_cards = game_fields.CardSetField(
+        help_text='bitmap of max_decks*52 cards which represents last cards that were played')
     last_user = models.ForeignKey(
         GamePlayer,
         on_delete=models.CASCADE,
@@ -85,6 +200,139 @@ class GameTableSnapshot(common_models.TimeStampModel):
         null=True, help_text='bluff was successful or not')
     did_skip = models.NullBooleanField(
         help_text='if cureent user skipped his turn')
+    version = models.PositiveIntegerField(
+        default=0, help_text='position of the snapshot in its game')
+    action = models.CharField(
+        max_length=16, choices=ACTIONS, blank=True,
+        help_text='action which made the snapshot')
+
+    class Meta:
+        unique_together = ('game', 'version')
 
     def __str__(self):
         return f'{self.game}'
+
+    @property
+    def is_checkpoint(self):
+        '''Tells if the snapshot must be stored as it is'''
+        return self.action not in GameEvent.MOVES \
+            or self.version % game_constants.CHECKPOINT_INTERVAL == 0
+
+
+class GameEvent(models.Model):
+    '''
+    Model to store a move of a game, the table of a version is made by
+    applying events after the previous checkpoint GameTableSnapshot
+    Players are stored by seat, events are never updated
+    '''
+    MOVES = ('join', 'play', 'callBluff', 'skip')
+
+    game = models.ForeignKey(
+        Game, on_delete=models.CASCADE, help_text='instance of the game')
+    version = models.PositiveIntegerField(
+        help_text='version of the game made by the event')
+    action = models.CharField(
+        max_length=16, choices=GameTableSnapshot.ACTIONS,
+        help_text='move made by the player')
+    seat = models.PositiveSmallIntegerField(
+        help_text='player_id of the player who made the move')
+    cards = game_fields.CardSetField(
+        null=True, help_text='bitmap of cards played, only for play')
+    rank = models.PositiveSmallIntegerField(
+        null=True, help_text='rank claimed for cards played, only for play')
+    next_seat = models.PositiveSmallIntegerField(
+        null=True, help_text='player_id of the player in turn after the move')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('game', 'version')
+
+    def __str__(self):
+        return f'{self.game_id} {self.version} {self.action}'
+
+    @classmethod
+    def from_snapshot(cls, snapshot, actor):
+        '''Returns event of actor making snapshot'''
+        played = snapshot.action == 'play'
+        current_user = snapshot.current_user
+        return cls(
+            game=snapshot.game,
+            version=snapshot.version,
+            action=snapshot.action,
+            seat=actor.player_id,
+            cards=snapshot.last_cards if played else None,
+            rank=snapshot.current_rank if played else None,
+            next_seat=current_user.player_id if current_user else None,
+        )
+
+    def apply(self, table, seats):
+        '''
+        Returns unsaved GameTableSnapshot made by the event on table
+        seats maps player_ids to GamePlayers
+        '''
+        snapshot = GameTableSnapshot(
+            game_id=self.game_id,
+            version=self.version,
+            action=self.action,
+            cards_on_table=table.cards_on_table,
+            last_cards=table.last_cards,
+            current_rank=table.current_rank,
+            last_user_id=table.last_user_id,
+            current_user=seats.get(self.next_seat),
+        )
+        actor = seats[self.seat]
+        if self.action == 'play':
+            snapshot.cards_on_table = table.cards_on_table | self.cards
+            snapshot.last_cards = self.cards
+            snapshot.current_rank = self.rank
+            snapshot.last_user = actor
+        elif self.action == 'callBluff' or (
+                self.action == 'skip' and table.last_user_id == actor.id):
+            snapshot.cards_on_table = snapshot.last_cards = CardSet()
+            snapshot.current_rank = snapshot.last_user = None
+            if self.action == 'callBluff':
+                snapshot.bluff_caller = actor
+                snapshot.bluff_successful = not table.last_cards.from_rank(
+                    table.current_rank)
+        return snapshot
+
+
+class PlayerDailyStats(common_models.TimeStampModel):
+    '''
+    Model to store bluff and game counts of a user for a day
+    Rows are incremented as games are played, so stats of a date range
+    are read without scanning games and snapshots
+    '''
+    COUNTERS = ('bluffs_called', 'bluffs_successful',
+                'bluffs_failed', 'games_played')
+
+    user = models.ForeignKey(accounts_models.User,
+                             on_delete=models.CASCADE, help_text='user whose stats are stored')
+    day = models.DateField(help_text='day on which the actions happened')
+    bluffs_called = models.PositiveIntegerField(
+        default=0, help_text='no of times user called bluff')
+    bluffs_successful = models.PositiveIntegerField(
+        default=0, help_text='no of called bluffs which were bluffs')
+    bluffs_failed = models.PositiveIntegerField(
+        default=0, help_text='no of called bluffs which were not bluffs')
+    games_played = models.PositiveIntegerField(
+        default=0, help_text='no of games finished by user')
+
+    class Meta:
+        unique_together = ('user', 'day')
+
+    def __str__(self):
+        return f'{self.user_id} {self.day}'
+
+    @classmethod
+    def increment(cls, user_id, day, **counts):
+        '''Adds counts to stats of the user for the day'''
+        updates = {field: F(field) + count for field, count in counts.items()}
+        if cls.objects.filter(user_id=user_id, day=day).update(**updates):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(user_id=user_id, day=day, **counts)
+        except IntegrityError:
+            # Row was created by someone else meanwhile
+            cls.objects.filter(user_id=user_id, day=day).update(**updates)
@@ -0,0 +1,159 @@
+import json
+
+import msgpack
+
+from apps.game.cards import CardSet
+
+MSGPACK_SUBPROTOCOL = 'bluff.msgpack.v1'
+
+# Keys of messages sent to msgpack clients, unknown keys are sent as they are
+SHORT_KEYS = {
+    'init_success': 'ok',
+    'message': 'm',
+    'game': 'g',
+    'game_players': 'p',
+    'self': 's',
+    'game_table': 't',
+    'bluff_cards': 'bc',
+    'action': 'a',
+    'last_player_turn': 'lt',
+    'bluffLooser': 'bl',
+    'userId': 'ui',
+    'userName': 'un',
+    'started': 'st',
+    'winner': 'w',
+    'owner': 'o',
+    'winner_name': 'wn',
+    'player_id': 'pid',
+    'disconnected': 'd',
+    'user': 'u',
+    'id': 'i',
+    'name': 'n',
+    'email': 'e',
+    'card_count': 'cc',
+    'cards': 'c',
+    'currentSet': 'cs',
+    'current_player_id': 'cp',
+    'last_player_id': 'lp',
+    'last_card_count': 'lc',
+    'seq': 'q',
+    'patch': 'pt',
+    'epoch': 'ep',
+    'resumed': 'rs',
+}
+# Card strings sent as packed CardSet bytes
+PACKED_KEYS = {'cards', 'bluff_cards'}
+# Keys of messages received from msgpack clients
+LONG_KEYS = {
+    'a': 'action',
+    'c': 'cardsPlayed',
+    'r': 'set',
+}
+
+
+def compact(value):
+    '''Shortens keys of value and packs card strings'''
+    if isinstance(value, dict):
+        return {
+            SHORT_KEYS.get(key, key):
+                CardSet.from_string(item).to_bytes()
+                if key in PACKED_KEYS and isinstance(item, str)
+                else compact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [compact(item) for item in value]
+    return value
+
+
+class JsonCodec:
+    '''
+    Default protocol, JSON text frames
+    '''
+    subprotocol = None
+
+    def encode(self, content):
+        '''Returns keyword arguments of send for content'''
+        return {'text_data': json.dumps(content)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        '''Returns received message or None when it can not be read'''
+        if text_data is None:
+            return None
+        try:
+            return json.loads(text_data)
+        except ValueError:
+            return None
+
+
+class MsgpackCodec(JsonCodec):
+    '''
+    msgpack binary frames with short keys and packed hands
+    JSON text frames are still understood
+    '''
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def encode(self, content):
+        return {'bytes_data': msgpack.packb(compact(content),
+                                            use_bin_type=True)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return super().decode(text_data)
+        try:
+            content = msgpack.unpackb(bytes_data, raw=False)
+        except Exception:
+            return None
+        if not isinstance(content, dict):
+            return None
+        content = {LONG_KEYS.get(key, key): value
+                   for key, value in content.items()}
+        if isinstance(content.get('cardsPlayed'), bytes):
+            try:
+                content['cardsPlayed'] = CardSet.from_bytes(
+                    content['cardsPlayed']).to_string()
+            except ValueError:
+                return None
+        return content
+
+
+def dict_patch(old, new):
+    '''Returns items of new which are missing or different in old'''
+    return {key: value for key, value in new.items()
+            if key not in old or old[key] != value}
+
+
+def state_patch(old, new):
+    '''
+    Returns changes between two public game states
+    Players are identified by player_id, only their changed fields are sent
+    '''
+    if old is None:
+        return dict(new)
+    patch = {}
+    for key in ('game', 'game_table'):
+        changes = dict_patch(old[key], new[key])
+        if changes:
+            patch[key] = changes
+    old_players = {player['player_id']: player
+                   for player in old['game_players']}
+    players = []
+    for player in new['game_players']:
+        changes = dict_patch(old_players.get(player['player_id'], {}), player)
+        if changes:
+            changes['player_id'] = player['player_id']
+            players.append(changes)
+    if players:
+        patch['game_players'] = players
+    return patch
+
+
+json_codec = JsonCodec()
+msgpack_codec = MsgpackCodec()
+
+
+def negotiate(scope):
+    '''Returns codec for subprotocols offered by the client'''
+    if MSGPACK_SUBPROTOCOL in scope.get('subprotocols', []):
+        return msgpack_codec
+    return json_codec
@@ -1,7 +1,20 @@
+from django.conf import settings
 from django.conf.urls import url
 
 from apps.game import consumers as game_consumers
 
+# Both consumers speak the same protocol, sync/ and async/ routes let them
+# be benchmarked side by side, GAME_CONSUMER picks the default one
+game_consumer_classes = {
+    'sync': game_consumers.GameConsumer,
+    'async': game_consumers.AsyncGameConsumer,
+}
+default_game_consumer = game_consumer_classes[
+    getattr(settings, 'GAME_CONSUMER', 'sync')]
+
 websocket_urlpatterns = [
-    url(r'ws/game/(?P<game_id>\w+)/$', game_consumers.GameConsumer),
+    url(r'ws/game/sync/(?P<game_id>\w+)/$', game_consumers.GameConsumer),
+    url(r'ws/game/async/(?P<game_id>\w+)/$',
+        game_consumers.AsyncGameConsumer),
+    url(r'ws/game/(?P<game_id>\w+)/$', default_game_consumer),
 ]
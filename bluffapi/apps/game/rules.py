@@ -0,0 +1,214 @@
+'''
+Rules of Bluff, free of database and channels
+
+Moves take the current table, the player making the move and the
+SeatRing of the game, and return an Outcome describing the next table,
+hands that changed and who won, or None when the move is not allowed.
+Nothing passed in is changed, so callers decide how to store outcomes
+
+Players only need id, player_id, disconnected and cards attributes and
+tables the attributes of Table, so GamePlayer and GameTableSnapshot
+instances can be passed as they are
+'''
+from apps.game.cards import CardSet
+
+
+class Player:
+    '''Plain stand in for GamePlayer'''
+    __slots__ = ('id', 'player_id', 'disconnected', 'cards')
+
+    def __init__(self, player_id, cards=CardSet(), disconnected=False):
+        self.id = player_id
+        self.player_id = player_id
+        self.disconnected = disconnected
+        self.cards = cards
+
+    def __repr__(self):
+        return f'Player({self.player_id})'
+
+
+class SeatRing:
+    '''
+    Turn order of the seated players of a game
+    Next player and next connected player of every seat are computed
+    when seats or connections change, so lookups during turns are O(1)
+    '''
+
+    def __init__(self, players=()):
+        self.rebuild(players)
+
+    def rebuild(self, players):
+        '''Recomputes the ring from GamePlayer instances'''
+        self.seats = sorted(
+            (player for player in players if player.player_id is not None),
+            key=lambda player: player.player_id
+        )
+        self._next = {}
+        self._next_connected = {}
+        count = len(self.seats)
+        for position, player in enumerate(self.seats):
+            following = [self.seats[(position + step) % count]
+                         for step in range(1, count)]
+            self._next[player.id] = following[0] if following else None
+            self._next_connected[player.id] = next(
+                (other for other in following if not other.disconnected),
+                None
+            )
+
+    def next_player(self, player, connected_only=True):
+        '''
+        Returns player sitting after player in the circle,
+        skipping disconnected ones when connected_only is set
+        '''
+        if connected_only:
+            return self._next_connected.get(player.id)
+        return self._next.get(player.id)
+
+    def __len__(self):
+        return len(self.seats)
+
+
+class Table:
+    '''Cards on the table and whose turn it is'''
+    __slots__ = ('cards_on_table', 'last_cards', 'current_rank', 'last_user',
+                 'current_user', 'bluff_caller', 'bluff_successful')
+
+    def __init__(self, cards_on_table=CardSet(), last_cards=CardSet(),
+                 current_rank=None, last_user=None, current_user=None,
+                 bluff_caller=None, bluff_successful=None):
+        self.cards_on_table = cards_on_table
+        self.last_cards = last_cards
+        self.current_rank = current_rank
+        self.last_user = last_user
+        self.current_user = current_user
+        self.bluff_caller = bluff_caller
+        self.bluff_successful = bluff_successful
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class Outcome:
+    '''
+    Result of a move
+    hands maps players whose cards changed to their new cards,
+    loser is set when a bluff was called and discarded holds cards
+    taken out of the game when the table was cleared
+    '''
+    __slots__ = ('table', 'hands', 'winner', 'loser', 'discarded')
+
+    def __init__(self, table, hands=None, winner=None, loser=None,
+                 discarded=CardSet()):
+        self.table = table
+        self.hands = hands or {}
+        self.winner = winner
+        self.loser = loser
+        self.discarded = discarded
+
+    def cards_of(self, player):
+        '''Returns cards of player after the move'''
+        return self.hands.get(player, player.cards)
+
+
+def is_turn(table, player, ring):
+    '''
+    Checks if player may play or skip on table
+    Turn of a disconnected player is taken by the next connected one
+    '''
+    if table.current_user is not None and table.current_user.disconnected:
+        return ring.next_player(table.current_user) == player
+    return table.current_user == player
+
+
+def player_in_turn(table, ring):
+    '''Returns the player who may play or skip on table'''
+    current = table.current_user
+    if current is not None and current.disconnected:
+        return ring.next_player(current)
+    return current
+
+
+def play(table, player, cards_played, rank, ring):
+    '''
+    player puts cards_played on the table claiming they are of rank
+    Previous player wins if he is left with no cards
+    '''
+    if not is_turn(table, player, ring) \
+            or not cards_played.issubset(player.cards):
+        return None
+    next_user = ring.next_player(player)
+    winner = None
+    if table.last_user is not None and not table.last_user.cards:
+        winner, next_user = table.last_user, None
+    return Outcome(
+        Table(
+            cards_on_table=table.cards_on_table | cards_played,
+            last_cards=cards_played,
+            current_rank=rank,
+            last_user=player,
+            current_user=next_user,
+        ),
+        hands={player: player.cards - cards_played},
+        winner=winner,
+    )
+
+
+def call_bluff(table, player, ring):
+    '''
+    player calls bluff on the last cards played
+    Whoever is wrong takes all cards on the table, the caller begins
+    next round if it was a bluff, the last player otherwise
+    '''
+    last_user = table.last_user
+    if table.current_user is None or not (
+            is_turn(table, player, ring)
+            or ring.next_player(table.current_user) == player) \
+            or last_user is None or last_user == player:
+        return None
+    bluff_successful = not table.last_cards.from_rank(table.current_rank)
+    if bluff_successful:
+        loser, next_user = last_user, player
+    else:
+        loser, next_user = player, last_user
+    outcome = Outcome(
+        Table(
+            current_user=next_user,
+            bluff_caller=player,
+            bluff_successful=bluff_successful,
+        ),
+        hands={loser: loser.cards | table.cards_on_table},
+        loser=loser,
+    )
+    if not outcome.cards_of(last_user):
+        outcome.winner = last_user
+        outcome.table.current_user = None
+    return outcome
+
+
+def skip(table, player, ring, started=True):
+    '''
+    player passes his turn
+    Table is discarded when it comes back to the last player, next
+    player wins if he has no cards left
+    '''
+    if not is_turn(table, player, ring):
+        return None
+    next_joined_player = ring.next_player(player, connected_only=False)
+    discarded = CardSet()
+    if table.last_user == player:
+        # Empty the table, he begins the next round
+        next_table = Table(current_user=player)
+        discarded = table.cards_on_table
+    else:
+        next_table = Table(
+            cards_on_table=table.cards_on_table,
+            last_cards=table.last_cards,
+            current_rank=table.current_rank,
+            last_user=table.last_user,
+            current_user=ring.next_player(player),
+        )
+    outcome = Outcome(next_table, discarded=discarded)
+    if started and not next_joined_player.cards:
+        outcome.winner = next_joined_player
+        next_table.current_user = None
+    return outcome
@@ -1,11 +1,36 @@
-from django.db.models import Q
+from django.db.models import Case, When, Value
 from django.db import transaction, IntegrityError
+from django.utils import timezone
 
 from rest_framework import serializers, exceptions
 
-from apps.game.models import Game, GamePlayer, GameTableSnapshot
+from apps.game.models import (
+    Game, GamePlayer, GameTableSnapshot, PlayerDailyStats
+)
 from apps.accounts import models as accounts_model
 from apps.game import constants as game_constants
+from apps.game.cards import CardSet
+from apps.game.fields import CardSetField
+
+
+class CardsField(serializers.Field):
+    '''
+    Represents a CardSet as string of length MAX_CARD_LENGTH made of 0 and 1
+    '''
+    default_error_messages = {
+        'invalid': 'Invalid cards config'
+    }
+
+    def to_representation(self, value):
+        return value.to_string()
+
+    def to_internal_value(self, data):
+        if isinstance(data, CardSet):
+            return data
+        try:
+            return CardSet.from_string(data)
+        except ValueError:
+            self.fail('invalid')
 
 
 class CreateGameSerializer(serializers.ModelSerializer):
@@ -27,8 +52,7 @@ class CreateGameSerializer(serializers.ModelSerializer):
 
     def initial_cards(self, decks):
         ''' Initializes cards based on the decks'''
-        max_decks = int(game_constants.MAX_CARD_LENGTH/52)
-        return f"{'1'*decks}{'0'*(max_decks-decks)}"*52
+        return CardSet.full(decks)
 
     def create(self, validated_data):
         '''
@@ -40,7 +64,8 @@ class CreateGameSerializer(serializers.ModelSerializer):
                 started=False,
                 owner=self.context['request'].user,
                 winner=None,
-                decks=validated_data['decks']
+                decks=validated_data['decks'],
+                seats_taken=1  # owner sits first
             )
             myself = GamePlayer.objects.create(
                 user=self.context['request'].user,
@@ -48,19 +73,21 @@ class CreateGameSerializer(serializers.ModelSerializer):
                 player_id=1,
                 disconnected=True,
                 no_action=0,
-                cards='0'*game_constants.MAX_CARD_LENGTH,  # Player has no cards initially
+                cards=CardSet(),  # Player has no cards initially
             )
             GameTableSnapshot.objects.create(
                 game=game,
                 current_rank=None,
                 cards_on_table=self.initial_cards(
                     game.decks),  # All cards on table
-                last_cards='0'*game_constants.MAX_CARD_LENGTH,  # no last cards
+                last_cards=CardSet(),  # no last cards
                 last_user=None,
                 current_user=myself,
                 bluff_caller=None,
                 bluff_successful=None,
-                did_skip=None
+                did_skip=None,
+                version=1,
+                action='create'
             )
         return game
 
@@ -79,6 +106,55 @@ class CreateGamePlayerSerializer(serializers.ModelSerializer):
         return super().validate(data)
 
 
+class InviteGamePlayersSerializer(serializers.Serializer):
+    '''
+    Invites users of the given emails to a game at once
+    Owner of the game can invite only users not invited already
+    '''
+    game = serializers.PrimaryKeyRelatedField(queryset=Game.objects.all())
+    users = serializers.ListField(
+        child=serializers.EmailField(), min_length=1,
+        max_length=game_constants.MAX_INVITES)
+
+    def validate(self, data):
+        game = data['game']
+        if game.owner != self.context['request'].user:
+            raise serializers.ValidationError('User is not the owner of game')
+        emails = set(data['users'])
+        users = list(accounts_model.User.objects.filter(email__in=emails))
+        missing = emails - {user.email for user in users}
+        if missing:
+            raise serializers.ValidationError(
+                f'Users do not exist: {", ".join(sorted(missing))}')
+        invited = set(game.gameplayer_set.filter(
+            user__in=users).values_list('user__email', flat=True))
+        if invited:
+            raise serializers.ValidationError(
+                f'Users already invited: {", ".join(sorted(invited))}')
+        data['users'] = users
+        return data
+
+    def create(self, validated_data):
+        '''Creates all GamePlayers with a single INSERT'''
+        game = validated_data['game']
+        try:
+            with transaction.atomic():
+                GamePlayer.objects.bulk_create([
+                    GamePlayer(game=game, user=user, cards=CardSet())
+                    for user in validated_data['users']
+                ])
+        except IntegrityError:
+            # Invited by another request meanwhile
+            raise serializers.ValidationError('Users already invited')
+        return validated_data
+
+    def to_representation(self, instance):
+        return {
+            'game': instance['game'].id,
+            'users': [user.email for user in instance['users']],
+        }
+
+
 class GameSerializer(serializers.ModelSerializer):
     '''
     Serializer to return list of games
@@ -100,31 +176,18 @@ class SocketInitSerializer(serializers.Serializer):
         min_value=1
     )
 
-    def validate_game(self, value):
-        '''
-        checks if game exists
-        returns game object
-        '''
-        game = Game.objects.filter(id=value)
-        if not game.exists():
-            raise exceptions.ValidationError('Game does not exist')
-        return value
-
-    def validate_user(self, value):
-        '''
-        check if the user exists
-        '''
-        if not accounts_model.User.objects.filter(id=value).exists():
-            raise exceptions.ValidationError('User does not exist')
-        return value
-
     def validate(self, data):
         '''
         validates if the users is part of the game and game is not started yet
+        Takes one query when he is, the reason is looked up otherwise
         '''
-        game_player = GamePlayer.objects.select_related('game').filter(
+        game_player = GamePlayer.objects.select_related('game', 'user').filter(
             game_id=data['game'], user_id=data['user']).first()
         if game_player is None:
+            if not Game.objects.filter(id=data['game']).exists():
+                raise exceptions.ValidationError('Game does not exist')
+            if not accounts_model.User.objects.filter(id=data['user']).exists():
+                raise exceptions.ValidationError('User does not exist')
             raise exceptions.ValidationError('User not a part of given game')
         elif game_player.player_id is None and game_player.game.started:
             raise exceptions.ValidationError(
@@ -159,17 +222,15 @@ class SocketGamePlayerSerializer(serializers.ModelSerializer):
     '''
     card_count = serializers.SerializerMethodField()
     user = GamePlayerUserSerializer()
+    cards = CardsField(write_only=True)
 
     class Meta:
         model = GamePlayer
         fields = ['player_id', 'disconnected', 'user', 'card_count', 'cards']
-        extra_kwargs = {
-            'cards': {'write_only': True}
-        }
 
     def get_card_count(self, obj):
         '''Returns count of the cards present from cards field'''
-        return obj.cards.count('1')
+        return obj.cards.count()
 
 
 class SocketMyselfSerializer(serializers.ModelSerializer):
@@ -177,6 +238,7 @@ class SocketMyselfSerializer(serializers.ModelSerializer):
     Serializer to handle properties of current gamePlayer
     '''
     user = GamePlayerUserSerializer()
+    cards = CardsField()
 
     class Meta:
         model = GamePlayer
@@ -200,7 +262,7 @@ class SocketGameTableSerializer(serializers.ModelSerializer):
 
     def get_card_count(self, obj):
         '''returns count of cards_on_table'''
-        return obj.cards_on_table.count('1')
+        return obj.cards_on_table.count()
 
     def get_current_player_id(self, obj):
         return obj.current_user.player_id if obj.current_user else None
@@ -210,7 +272,7 @@ class SocketGameTableSerializer(serializers.ModelSerializer):
 
     def get_last_card_count(self, obj):
         '''returns count of last_cards_played'''
-        return obj.last_cards.count('1') if obj.last_cards else None
+        return obj.last_cards.count() if obj.last_cards is not None else None
 
     def get_currentSet(self, obj):
         return obj.current_rank
@@ -220,7 +282,7 @@ class DistributeCardsSerializer(serializers.Serializer):
     '''
     It Distributes Cards among all players and save their cards
     '''
-    all_player_cards = serializers.DictField()
+    all_player_cards = serializers.DictField(child=CardsField())
 
     class Meta:
         fields = ['all_player_cards']
@@ -229,32 +291,47 @@ class DistributeCardsSerializer(serializers.Serializer):
         '''It updates cards,starts game and updates gameTable'''
         game = self.context['game']
         game.started = True
-        last_table_snapshot = game.gametablesnapshot_set.latest('updated_at')
+        last_table_snapshot = game.get_current_snapshot()
+        all_player_cards = validated_data['all_player_cards']
         with transaction.atomic():
-            for player_id, cards in validated_data['all_player_cards'].items():
-                player = GamePlayer.objects.get(game=game, player_id=player_id)
-                player.cards = cards
-                player.save()
+            # Django 1.11 has no bulk_update, every hand is written
+            # by a single UPDATE .. CASE statement instead
+            game.gameplayer_set.filter(
+                player_id__in=list(all_player_cards)
+            ).update(cards=Case(
+                *[When(player_id=player_id,
+                       then=Value(cards, output_field=CardSetField()))
+                  for player_id, cards in all_player_cards.items()],
+                output_field=CardSetField()
+            ))
             # Clear Game Table
-            last_table_snapshot.cards_on_table = '0'*game_constants.MAX_CARD_LENGTH
-            last_table_snapshot.save()
-            game.save()
+            GameTableSnapshot.objects.create(
+                game=game,
+                current_rank=last_table_snapshot.current_rank,
+                cards_on_table=CardSet(),
+                last_cards=last_table_snapshot.last_cards,
+                last_user=last_table_snapshot.last_user,
+                current_user=last_table_snapshot.current_user,
+                version=last_table_snapshot.version + 1,
+                action='start'
+            )
+            game.save(update_fields=['started', 'updated_at'])
         return game
 
     def validate(self, data):
         '''
         checks if each player exists
         '''
-        for player_id, cards in data['all_player_cards'].items():
+        game = self.context['game']
+        player_ids = {int(player_id)
+                      for player_id in data['all_player_cards']}
+        existing_ids = set(game.gameplayer_set.filter(
+            player_id__in=player_ids).values_list('player_id', flat=True))
+        missing_ids = player_ids - existing_ids
+        if missing_ids:
             # If no such game player id exists
-            game = self.context['game']
-            if not game.gameplayer_set\
-                    .filter(player_id=player_id).exists():
-                raise Exception(
-                    f'player id {player_id} does not exist for this game')
-            if len(cards) != game_constants.MAX_CARD_LENGTH:
-                raise Exception(
-                    f'Invalid cards config set for player id {player_id}')
+            raise Exception(
+                f'player id {min(missing_ids)} does not exist for this game')
         return data
 
 # Intended for stats part of project.
@@ -277,22 +354,12 @@ class TimelineSerializer(serializers.Serializer):
 
     def to_representation(self, instance):
         super().to_representation(instance)
-
-        all_game_players = self.context['user'].gameplayer_set.filter(
-            Q(game__created_at__gt=instance['start_date'])
-            & Q(game__created_at__lt=instance['end_date'])
-            & Q(player_id__isnull=False))
-        bluff_caller_instances = GameTableSnapshot.objects.filter(
-            bluff_caller__in=all_game_players
-        )
-        successful_bluffs = bluff_caller_instances.filter(
-            bluff_successful=True)
-        unsuccessful_bluffs = bluff_caller_instances.filter(
-            bluff_successful=False)
-
-        instance['successful_bluffs'] = successful_bluffs
-        instance['unsuccessful_bluffs'] = unsuccessful_bluffs
-        instance['all_game_players'] = all_game_players
+        # Stats are kept per day in local time
+        instance['daily_stats'] = PlayerDailyStats.objects.filter(
+            user=self.context['user'],
+            day__gte=timezone.localdate(instance['start_date']),
+            day__lte=timezone.localdate(instance['end_date']),
+        ).order_by('day')
         return instance
 
 
@@ -322,7 +389,7 @@ class GameStatsSerializer(serializers.ModelSerializer):
 
     def get_card_count(self, obj):
         '''Returns count of the cards present from cards field'''
-        return obj.cards.count('1')
+        return obj.cards.count()
 
     def get_owner(self, obj):
         '''Returns if current user is the owner of game'''
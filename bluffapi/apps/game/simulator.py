@@ -0,0 +1,114 @@
+'''
+Bot versus bot games played in memory through apps.game.rules
+Used by bench_rules to time the rules and by simulate_games to
+fuzz them, checking invariants after every move
+'''
+from apps.game import rules
+from apps.game.cards import CARDS_PER_RANK, CardSet, deal
+
+# Moves after which a game going round in circles is abandoned
+MAX_GAME_MOVES = 10000
+
+
+class InvariantViolation(Exception):
+    '''A move left the game in a state the rules must never reach'''
+
+
+class SelfPlayGame:
+    '''
+    A game between bots choosing random legal actions
+    Bots call bluff on 1 of 5 turns, skip on 1 of 10 and play a single
+    card otherwise, claiming its real rank half of the times.
+    With disconnect_rate, a random player drops or comes back before
+    a move, as long as two players stay connected
+    '''
+
+    def __init__(self, player_count, decks, rng, check=True,
+                 disconnect_rate=0):
+        self.rng = rng
+        self.check = check
+        self.disconnect_rate = disconnect_rate
+        self.players = [
+            rules.Player(player_id, cards) for player_id, cards in
+            enumerate(deal(CardSet.full(decks), player_count, rng), 1)
+        ]
+        self.ring = rules.SeatRing(self.players)
+        self.table = rules.Table(current_user=self.players[0])
+        self.dealt = CardSet()
+        self.discarded = CardSet()
+        for player in self.players:
+            self.dealt |= player.cards
+        self.moves = 0
+        self.winner = None
+
+    def play(self, max_moves=MAX_GAME_MOVES):
+        '''Plays till someone wins, returns the winner or None if abandoned'''
+        while self.winner is None and self.moves < max_moves:
+            self.step()
+        return self.winner
+
+    def step(self):
+        if self.disconnect_rate and self.rng.random() < self.disconnect_rate:
+            self.toggle_connection()
+        table = self.table
+        player = rules.player_in_turn(table, self.ring)
+        roll = self.rng.random()
+        if table.last_user not in (None, player) and roll < 0.2:
+            action, outcome = 'callBluff', rules.call_bluff(
+                table, player, self.ring)
+        elif player.cards and roll < 0.9:
+            card = self.rng.choice(list(player.cards))
+            rank = card // CARDS_PER_RANK + 1 if self.rng.random() < 0.5 \
+                else self.rng.randint(1, 13)
+            action, outcome = 'play', rules.play(
+                table, player, CardSet(1 << card), rank, self.ring)
+        else:
+            action, outcome = 'skip', rules.skip(table, player, self.ring)
+        if outcome is None:
+            raise InvariantViolation(
+                f'{action} of current player {player} was refused')
+        for changed, cards in outcome.hands.items():
+            changed.cards = cards
+        self.discarded |= outcome.discarded
+        self.table = outcome.table
+        self.winner = outcome.winner
+        self.moves += 1
+        if self.check:
+            self.check_invariants(action)
+
+    def toggle_connection(self):
+        player = self.rng.choice(self.players)
+        connected = [other for other in self.players if not other.disconnected]
+        if not player.disconnected and len(connected) <= 2:
+            return
+        player.disconnected = not player.disconnected
+        self.ring.rebuild(self.players)
+
+    def check_invariants(self, action):
+        '''Raises InvariantViolation when the last move broke the rules'''
+        table = self.table
+        held = [table.cards_on_table, self.discarded] + [
+            player.cards for player in self.players]
+        if sum(cards.count() for cards in held) != self.dealt.count():
+            raise InvariantViolation(f'{action} created or lost cards')
+        union = CardSet()
+        for cards in held:
+            union |= cards
+        if union != self.dealt:
+            raise InvariantViolation(f'{action} moved cards out of the deck')
+        if not table.last_cards.issubset(table.cards_on_table):
+            raise InvariantViolation(f'{action} left last cards off the table')
+        if self.winner is not None:
+            if self.winner.cards:
+                raise InvariantViolation(
+                    f'{self.winner} won with cards left after {action}')
+            if table.current_user is not None:
+                raise InvariantViolation(f'{action} kept the game going')
+            return
+        if table.current_user not in self.ring.seats:
+            raise InvariantViolation(f'{action} left no current player')
+        in_turn = [player for player in self.ring.seats
+                   if rules.is_turn(table, player, self.ring)]
+        if len(in_turn) != 1:
+            raise InvariantViolation(
+                f'{action} left {len(in_turn)} players in turn')
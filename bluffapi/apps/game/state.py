@@ -0,0 +1,506 @@
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+
+from django.db import (
+    IntegrityError, close_old_connections, connection, transaction
+)
+from django.utils import timezone
+
+from apps.game import constants as game_constants, protocol
+from apps.game.models import (
+    Game, GameEvent, GamePlayer, GameTableSnapshot, PlayerDailyStats
+)
+from apps.game.rules import SeatRing
+from apps.game.timers import game_timers
+
+logger = logging.getLogger(__name__)
+
+
+class VersionConflict(Exception):
+    '''Snapshots of the game were appended by someone else meanwhile'''
+
+
+class GameState:
+    '''
+    In memory authoritative state of a game kept by the worker
+    Holds the game, its players and the current table snapshot as
+    model instances, changes are written to the database by flush()
+
+    Every read or change must be done while holding lock
+    '''
+
+    def __init__(self, game_id, on_reload=None):
+        self.game_id = game_id
+        # called with the state when a conflicting write reloaded it
+        self.on_reload = on_reload
+        self.lock = threading.RLock()
+        self.game = None
+        self.players = OrderedDict()  # GamePlayer id -> GamePlayer
+        self.table = None  # latest GameTableSnapshot
+        self.ring = SeatRing()  # turn order of seated players
+        self.version = 0  # increases on every change of the state
+        self.seq = 0  # sequence number of last published game state
+        # sequence numbers restart when the state is loaded again
+        self.epoch = uuid.uuid4().hex[:8]
+        self.public_state = None  # last published public game state
+        self.history = deque(maxlen=game_constants.RESUME_BUFFER_SIZE)
+        self.sockets = Counter()  # GamePlayer id -> open sockets
+        self.timed_table = None  # table whose turn timer was started
+        self.released = False  # set once the store has forgotten the state
+        self._pending_snapshots = []  # checkpoints not yet inserted
+        self._pending_events = []  # GameEvents not yet inserted
+        self._dirty = OrderedDict()  # id(instance) -> (instance, fields)
+        self._stats = defaultdict(Counter)  # (user id, day) -> counts
+        self._disconnected = set()  # GamePlayer ids to disconnect in bulk
+
+    def load(self):
+        '''
+        (Re)loads the state from database, player instances are updated
+        in place so that references to them stay valid
+        '''
+        with self.lock:
+            # Game comes along with its players
+            players = list(GamePlayer.objects.select_related(
+                'user', 'game__owner', 'game__winner'
+            ).filter(game_id=self.game_id).order_by('id'))
+            if players:
+                game = players[0].game
+            else:
+                game = Game.objects.select_related(
+                    'owner', 'winner').get(id=self.game_id)
+            table = game.get_current_snapshot(players)
+            if self.game is None:
+                self.game = game
+            else:
+                self.game.__dict__.update(game.__dict__)
+            for player in players:
+                self._merge_player(player)
+            if table is not None:
+                self._bind_snapshot(table)
+            self.table = table
+            self.ring.rebuild(self.players.values())
+            self._pending_snapshots = []
+            self._pending_events = []
+            self._dirty = OrderedDict()
+            self.version += 1
+
+    def _merge_player(self, player):
+        '''Adds player to the state or updates the existing instance'''
+        existing = self.players.get(player.id)
+        if existing is None:
+            self.players[player.id] = player
+            existing = player
+        else:
+            existing.__dict__.update(player.__dict__)
+        existing.game = self.game
+        return existing
+
+    def _bind_snapshot(self, snapshot):
+        '''Points player foreign keys of snapshot to instances of the state'''
+        snapshot.game = self.game
+        for field in ('last_user', 'current_user', 'bluff_caller'):
+            player_id = getattr(snapshot, f'{field}_id')
+            if player_id is not None and player_id in self.players:
+                setattr(snapshot, field, self.players[player_id])
+
+    def add_player(self, game_player):
+        '''
+        Returns instance of game_player kept by the state
+        adds it when player was invited after the state was loaded
+        '''
+        with self.lock:
+            if game_player.id in self.players:
+                return self.players[game_player.id]
+            player = self._merge_player(game_player)
+            self.ring.rebuild(self.players.values())
+            return player
+
+    def get_player(self, game_player_id):
+        return self.players[game_player_id]
+
+    def player_for_user(self, user_id):
+        for player in self.players.values():
+            if player.user_id == user_id:
+                return player
+        return None
+
+    def seated_players(self):
+        '''Players who have been assigned a player_id ordered by it'''
+        return list(self.ring.seats)
+
+    def connected_players(self):
+        return [player for player in self.players.values()
+                if not player.disconnected]
+
+    def seat_player(self, player, player_id):
+        '''
+        Adds player to the ring with player_id, which is already written
+        with his connection by GamePlayer.take_seat
+        '''
+        with self.lock:
+            player.player_id = player_id
+            self.ring.rebuild(self.players.values())
+            self.version += 1
+
+    def set_connected(self, player, connected):
+        '''
+        Marks player (dis)connected and updates the ring, nothing is
+        written when he already is, as after GamePlayer.take_seat
+        '''
+        with self.lock:
+            if player.disconnected == connected:
+                player.disconnected = not connected
+                self.mark_dirty(player, 'disconnected')
+            self.ring.rebuild(self.players.values())
+
+    def attach(self, player):
+        '''
+        Counts a socket opened by player
+        Returns whether his pending disconnect was cancelled, that is he
+        came back within the grace period and is still connected
+        '''
+        with self.lock:
+            self.sockets[player.id] += 1
+            return game_timers.cancel(self.disconnect_key(player))
+
+    def detach(self, player):
+        '''Returns whether player has no open sockets left'''
+        with self.lock:
+            self.sockets[player.id] -= 1
+            if self.sockets[player.id] > 0:
+                return False
+            del self.sockets[player.id]
+            return True
+
+    def disconnect_key(self, player):
+        '''Key of the timer disconnecting player'''
+        return ('disconnect', self.game_id, player.id)
+
+    def disconnect_all(self):
+        '''
+        Marks every connected player disconnected at once, they are
+        written with a single UPDATE on next flush
+        Returns players who were connected
+        '''
+        with self.lock:
+            players = self.connected_players()
+            for player in players:
+                player.disconnected = True
+                game_timers.cancel(self.disconnect_key(player))
+                self._disconnected.add(player.id)
+                dirty = self._dirty.get(id(player))
+                if dirty is not None:
+                    dirty[1].discard('disconnected')
+            self.sockets.clear()
+            self.ring.rebuild(self.players.values())
+            self.version += 1
+            return players
+
+    def next_player(self, player, connected_only=True):
+        '''Returns next (connected) player after player in turn order'''
+        return self.ring.next_player(player, connected_only)
+
+    def publish(self, event):
+        '''
+        Numbers game_state of event as the next update sent to players,
+        adds its changes from the previous one and keeps it for replays
+        '''
+        with self.lock:
+            public_state = event['game_state']
+            self.seq += 1
+            event['seq'] = self.seq
+            event['patch'] = protocol.state_patch(
+                self.public_state, public_state)
+            self.public_state = public_state
+            self.history.append(event)
+            return event
+
+    def events_since(self, epoch, seq):
+        '''
+        Returns published events after seq
+        None when they are not kept anymore or seq is of another epoch
+        '''
+        with self.lock:
+            if epoch != self.epoch or seq > self.seq:
+                return None
+            missed = [event for event in self.history if event['seq'] > seq]
+            if len(missed) != self.seq - seq:
+                return None
+            return missed
+
+    def mark_dirty(self, instance, *fields):
+        '''Schedules fields of instance to be written on next flush'''
+        with self.lock:
+            key = id(instance)
+            if key in self._dirty:
+                self._dirty[key][1].update(fields)
+            else:
+                self._dirty[key] = (instance, set(fields))
+            self.version += 1
+
+    def push_table(self, action, actor, **changes):
+        '''
+        Pushes a copy of the current table with changes made by action
+        of actor
+        '''
+        with self.lock:
+            fields = {
+                field: getattr(self.table, field) for field in (
+                    'cards_on_table', 'last_cards', 'current_rank',
+                    'last_user', 'current_user')
+            }
+            fields.update(changes)
+            self.push_snapshot(GameTableSnapshot(
+                game=self.game, action=action, **fields), actor)
+
+    def push_snapshot(self, snapshot, actor=None):
+        '''
+        Makes snapshot the current table, the move of actor making it is
+        inserted on next flush, and the snapshot itself when it is a
+        checkpoint or nobody made it
+        '''
+        with self.lock:
+            self._bind_snapshot(snapshot)
+            snapshot.version = (self.table.version if self.table else 0) + 1
+            self.table = snapshot
+            if actor is not None and snapshot.action in GameEvent.MOVES:
+                self._pending_events.append(
+                    GameEvent.from_snapshot(snapshot, actor))
+            if actor is None or snapshot.is_checkpoint:
+                self._pending_snapshots.append(snapshot)
+            self.version += 1
+
+    def record_stats(self, user_id, **counts):
+        '''Adds counts to PlayerDailyStats of the user on next flush'''
+        with self.lock:
+            self._stats[user_id, timezone.localdate()].update(counts)
+
+    @property
+    def has_changes(self):
+        return bool(self._pending_snapshots or self._pending_events
+                    or self._dirty or self._stats or self._disconnected)
+
+    def flush(self):
+        '''
+        Writes all pending changes in one transaction
+        Changes are kept if writing fails so that next flush retries them,
+        they are dropped and the state reloaded if another worker changed
+        the game meanwhile
+        '''
+        with self.lock:
+            if not self.has_changes:
+                return
+            try:
+                self._write()
+            except VersionConflict:
+                logger.warning(
+                    'Game %s was changed by another worker, dropping its '
+                    'changes up to version %d', self.game_id,
+                    self.table.version)
+                self._reload()
+                if self.on_reload is not None:
+                    self.on_reload(self)
+                return
+            self._pending_snapshots = []
+            self._pending_events = []
+            self._dirty = OrderedDict()
+            self._stats = defaultdict(Counter)
+            self._disconnected = set()
+
+    def _write(self):
+        '''
+        Events and snapshots are appended only when game is still at the
+        version they were made from, as versions of a game are unique
+        '''
+        with transaction.atomic():
+            for key, (instance, fields) in self._dirty.items():
+                if isinstance(instance, GameTableSnapshot) or not fields:
+                    # Snapshots will be inserted with their latest values,
+                    # players disconnected in bulk may have nothing left
+                    continue
+                instance.save(update_fields=fields | {'updated_at'})
+            if self._disconnected:
+                GamePlayer.objects.filter(id__in=self._disconnected).update(
+                    disconnected=True)
+            if self._pending_snapshots or self._pending_events:
+                try:
+                    with transaction.atomic():
+                        GameEvent.objects.bulk_create(self._pending_events)
+                        self._create_snapshots(self._pending_snapshots)
+                except IntegrityError:
+                    raise VersionConflict(self.game_id)
+            for (user_id, day), counts in self._stats.items():
+                PlayerDailyStats.increment(user_id, day, **counts)
+
+    def _reload(self):
+        '''
+        Replaces the state with the one in database, updates published
+        since the last flush belong to another epoch now
+        '''
+        self._stats = defaultdict(Counter)
+        self._disconnected = set()
+        self.load()
+        self.epoch = uuid.uuid4().hex[:8]
+        self.public_state = None
+        self.history.clear()
+
+    def _create_snapshots(self, snapshots):
+        '''Inserts snapshots in order, in bulk when backend returns ids'''
+        if connection.features.can_return_ids_from_bulk_insert:
+            GameTableSnapshot.objects.bulk_create(snapshots)
+        else:
+            for snapshot in snapshots:
+                snapshot.save()
+
+
+class GameStateStore:
+    '''
+    Registry of GameStates of the worker
+    A background thread flushes changes of all games every
+    STATE_FLUSH_INTERVAL seconds
+
+    State is authoritative only when all sockets of a game are handled
+    by the same worker, so games must be routed to workers by game id
+    '''
+
+    def __init__(self, flush_interval=game_constants.STATE_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.draining = False  # set once the worker stops serving games
+        # called with a state reloaded after a conflicting write, to tell
+        # its players that updates they got were dropped
+        self.on_reload = None
+        self._states = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def peek(self, game_id):
+        '''Returns state of the game if it is in memory'''
+        with self._lock:
+            state = self._states.get(int(game_id))
+        if state is None or state.released:
+            return None
+        return state
+
+    def get(self, game_id):
+        '''Returns state of the game, loading it when not present'''
+        game_id = int(game_id)
+        with self._lock:
+            state = self._states.get(game_id)
+            if state is not None and not state.released:
+                return state
+            # Lock the new state so that nobody uses it before it is loaded
+            state = GameState(game_id, self.on_reload)
+            state.lock.acquire()
+            self._states[game_id] = state
+            self._start_flusher()
+        try:
+            state.load()
+        except Exception:
+            state.released = True
+            with self._lock:
+                if self._states.get(game_id) is state:
+                    del self._states[game_id]
+            raise
+        finally:
+            state.lock.release()
+        return state
+
+    @contextmanager
+    def locked(self, game_id):
+        '''Yields state of the game while holding its lock'''
+        while True:
+            state = self.get(game_id)
+            with state.lock:
+                if state.released:
+                    # Released while we were waiting for the lock
+                    continue
+                yield state
+                return
+
+    def release(self, game_id):
+        '''
+        Flushes state of the game and forgets it
+        Must not be called while holding lock of another game
+        '''
+        game_id = int(game_id)
+        with self._lock:
+            state = self._states.get(game_id)
+        if state is None:
+            return
+        with state.lock:
+            state.flush()
+            state.released = True
+        with self._lock:
+            if self._states.get(game_id) is state:
+                del self._states[game_id]
+
+    def clear(self):
+        '''
+        Forgets every game without writing it and serves games again
+        Unwritten changes are lost, meant for tests whose database was
+        rolled back
+        '''
+        with self._lock:
+            states, self._states = list(self._states.values()), {}
+            self.draining = False
+        for state in states:
+            with state.lock:
+                state.released = True
+
+    def flush_all(self):
+        with self._lock:
+            states = list(self._states.values())
+        for state in states:
+            try:
+                state.flush()
+            except Exception:
+                logger.exception(
+                    'Could not flush state of game %s', state.game_id)
+
+    def drain(self, leave):
+        '''
+        Stops serving games, leave(state) is called for every game while
+        holding its lock to disconnect its players, then its state is
+        flushed and forgotten
+        Returns (game id, event returned by leave) of every game
+        '''
+        self.draining = True
+        with self._lock:
+            states = list(self._states.values())
+        events = []
+        for state in states:
+            try:
+                with state.lock:
+                    if state.released:
+                        continue
+                    events.append((state.game_id, leave(state)))
+                self.release(state.game_id)
+            except Exception:
+                logger.exception('Could not drain game %s', state.game_id)
+        return events
+
+    def _start_flusher(self):
+        if self._flusher is not None or not self.flush_interval:
+            return
+        self._flusher = threading.Thread(
+            target=self._run_flusher, name='game-state-flusher', daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush_all)
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            # Drop a connection broken by a database restart meanwhile
+            close_old_connections()
+            try:
+                self.flush_all()
+            finally:
+                close_old_connections()
+
+
+game_states = GameStateStore()
@@ -1,25 +1,745 @@
+import gzip
+import io
 import json
+import os
+import random
+import tempfile
+import threading
+from datetime import date
 import pprint
 from deepdiff import DeepDiff
 
-from django.test import TestCase
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
 
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
+from rest_framework.test import APIRequestFactory
 from ddf import G
 import pytest
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
 
 from apps.accounts.models import User
-from apps.game.consumers import ChatConsumer
+from apps.game.consumers import (
+    GameActionsMixin, drain_games, resync_players
+)
+from apps.game.cards import RANK_MASKS, CardSet, deal
+from apps.game import constants as game_constants, metrics, protocol, rules
+from apps.game.simulator import SelfPlayGame
+from bluffapi.token_auth import token_cache
+from apps.game.state import game_states, GameStateStore, SeatRing
 from apps.game.models import *
 from bluffapi.routing import application
 from apps.game.serializers import *
 
 
+@pytest.fixture(autouse=True)
+def fresh_game_states():
+    '''
+    games kept in memory by a test are forgotten after it, as its
+    database is rolled back and the next test reuses the same ids
+    '''
+    yield
+    game_states.clear()
+
+
+class CardSetTest(TestCase):
+    '''
+    tests packed card operations against the card string representation
+    '''
+
+    def test_string_round_trip(self):
+        cards = '101101'*26
+        card_set = CardSet.from_string(cards)
+        self.assertEqual(card_set.to_string(), cards)
+        self.assertEqual(card_set.count(), cards.count('1'))
+        self.assertEqual(CardSet.from_bytes(card_set.to_bytes()), card_set)
+
+    def test_union_and_difference(self):
+        table = CardSet.from_string('101101'*26)
+        hand = CardSet.from_string('010010'*26)
+        self.assertEqual((table | hand).to_string(), '1'*156)
+        self.assertEqual((table | hand) - hand, table)
+        self.assertTrue(hand.issubset(table | hand))
+        self.assertFalse(hand.issubset(table))
+
+    def test_from_rank(self):
+        # first 12 indexes are all copies of aces
+        self.assertTrue(CardSet.from_string('1'*12+'0'*144).from_rank(1))
+        self.assertFalse(CardSet.from_string('1'*13+'0'*143).from_rank(1))
+        self.assertTrue(CardSet().from_rank(None))
+        self.assertFalse(CardSet.from_string('1'+'0'*155).from_rank(None))
+
+    def test_full_deck(self):
+        self.assertEqual(
+            CardSet.full(2).to_string(), f"{'1'*2}{'0'*1}"*52)
+
+    def test_invalid_string(self):
+        with self.assertRaises(ValueError):
+            CardSet.from_string('1'*155)
+        with self.assertRaises(ValueError):
+            CardSet.from_string('2'*156)
+
+    def test_deal(self):
+        hands = deal(CardSet.full(3), 5)
+        self.assertEqual([hand.count() for hand in hands], [31]*5)
+        dealt = CardSet()
+        for hand in hands:
+            self.assertFalse(hand & dealt)
+            dealt = dealt | hand
+        self.assertTrue(dealt.issubset(CardSet.full(3)))
+
+
+class DistributeCardsTest(TestCase):
+    '''
+    tests that hands are validated and written in bulk
+    '''
+
+    def test_hands_written_in_bulk(self):
+        game = G(Game, owner=G(User), decks=1)
+        G(GameTableSnapshot, game=game,
+          cards_on_table=CardSet.full(1), last_cards=CardSet())
+        players = [G(GamePlayer, game=game, user=G(User), cards=CardSet(),
+                     player_id=player_id) for player_id in (1, 2, 3)]
+        hands = deal(CardSet.full(1), 3)
+        serializer = DistributeCardsSerializer(
+            data={'all_player_cards': dict(enumerate(hands, start=1))},
+            context={'game': game})
+        with self.assertNumQueries(1):
+            self.assertTrue(serializer.is_valid())
+        serializer.save()
+        for player, hand in zip(players, hands):
+            self.assertEqual(GamePlayer.objects.get(id=player.id).cards, hand)
+        self.assertFalse(game.get_current_snapshot().cards_on_table)
+
+    def test_unknown_player(self):
+        game = G(Game, owner=G(User), decks=1)
+        serializer = DistributeCardsSerializer(
+            data={'all_player_cards': {1: CardSet()}},
+            context={'game': game})
+        with self.assertRaises(Exception):
+            serializer.is_valid()
+
+
+class GameStateTest(TestCase):
+    '''
+    tests that in memory changes reach database only when flushed
+    '''
+
+    def test_changes_written_on_flush(self):
+        user = G(User)
+        game = G(Game, owner=user, decks=1)
+        G(GameTableSnapshot, game=game,
+          cards_on_table=CardSet.full(1), last_cards=CardSet())
+        player = G(GamePlayer, game=game, user=user,
+                   cards=CardSet(), player_id=1)
+        store = GameStateStore(flush_interval=0)
+        played = CardSet.from_string('1'+'0'*155)
+        with store.locked(game.id) as state:
+            myself = state.get_player(player.id)
+            myself.cards = played
+            state.mark_dirty(myself, 'cards')
+            state.push_snapshot(GameTableSnapshot(
+                game=state.game, cards_on_table=played,
+                last_cards=played, current_user=myself))
+        self.assertFalse(GamePlayer.objects.get(id=player.id).cards)
+        self.assertEqual(
+            GameTableSnapshot.objects.filter(game=game).count(), 1)
+
+        store.release(game.id)
+        self.assertEqual(GamePlayer.objects.get(id=player.id).cards, played)
+        latest = Game.objects.get(id=game.id).get_current_snapshot()
+        self.assertEqual(latest.version, 1)
+        self.assertEqual(latest.cards_on_table, played)
+        self.assertEqual(latest.current_user_id, player.id)
+
+    def test_conflicting_flush_is_dropped(self):
+        '''
+        second worker appending to the same game version loses and
+        reloads what the first one wrote
+        '''
+        user = G(User)
+        game = G(Game, owner=user, decks=1)
+        G(GameTableSnapshot, game=game,
+          cards_on_table=CardSet.full(1), last_cards=CardSet())
+        G(GamePlayer, game=game, user=user, cards=CardSet(), player_id=1)
+        first, second = [GameStateStore(flush_interval=0) for i in range(2)]
+        second.on_reload = resync_players
+        channel_layer = get_channel_layer()
+        channel = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(f'game_{game.id}', channel)
+        for store, rank in ((first, 1), (second, 2)):
+            with store.locked(game.id) as state:
+                state.push_snapshot(GameTableSnapshot(
+                    game=state.game, cards_on_table=CardSet(),
+                    last_cards=CardSet(), current_rank=rank))
+                self.assertEqual(state.table.version, 1)
+
+        first.flush_all()
+        second.flush_all()
+        game = Game.objects.get(id=game.id)
+        self.assertEqual(game.get_current_snapshot().current_rank, 1)
+        self.assertEqual(
+            GameTableSnapshot.objects.filter(game=game).count(), 2)
+        with second.locked(game.id) as state:
+            self.assertEqual(state.table.current_rank, 1)
+            self.assertFalse(state.has_changes)
+        # players of the second worker are sent the state they missed
+        event = async_to_sync(channel_layer.receive)(channel)
+        self.assertEqual(event['action'], 'resync')
+        self.assertNotIn('patch', event)
+        self.assertEqual(event['game_state']['game_table']['currentSet'], 1)
+
+    def test_load_queries(self):
+        '''game with its players and the latest snapshot'''
+        user = G(User)
+        game = G(Game, owner=user, decks=1)
+        snapshots = [
+            G(GameTableSnapshot, game=game, version=version,
+              cards_on_table=CardSet.full(1), last_cards=CardSet())
+            for version in (2, 1)
+        ]
+        for player_id in (1, 2):
+            G(GamePlayer, game=game, cards=CardSet(), player_id=player_id)
+        store = GameStateStore(flush_interval=0)
+        # players, latest checkpoint and events after it
+        with self.assertNumQueries(3):
+            state = store.get(game.id)
+        self.assertEqual(len(state.seated_players()), 2)
+        self.assertEqual(state.table.id, snapshots[0].id)
+
+    def test_drain_disconnects_in_bulk(self):
+        user = G(User)
+        game = G(Game, owner=user, decks=1, started=True)
+        first, second, third = [
+            G(GamePlayer, game=game, user=G(User), cards=CardSet.full(1),
+              player_id=player_id, disconnected=False)
+            for player_id in (1, 2, 3)
+        ]
+        G(GameTableSnapshot, game=game, cards_on_table=CardSet(),
+          last_cards=CardSet(), current_user=first)
+        with game_states.locked(game.id) as state:
+            state.attach(state.get_player(first.id))
+        with CaptureQueriesContext(connection) as queries:
+            drain_games()
+        player_updates = [query for query in queries.captured_queries
+                          if query['sql'].startswith('UPDATE')
+                          and 'game_gameplayer' in query['sql']]
+        self.assertEqual(len(player_updates), 1)
+        # snapshots are only inserted
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].startswith('UPDATE')
+                          and 'game_gametablesnapshot' in query['sql']])
+        self.assertFalse(GamePlayer.objects.filter(
+            game=game, disconnected=False).exists())
+        # turn of the player in turn was skipped once
+        self.assertEqual(
+            Game.objects.get(id=game.id).get_current_snapshot().current_user_id,
+            second.id)
+        self.assertIsNone(game_states.peek(game.id))
+
+    def test_moves_replayed_from_checkpoint(self):
+        '''moves are stored as events, the table only every few versions'''
+        user = G(User)
+        game = G(Game, owner=user, decks=1, started=True)
+        hands = deal(CardSet.full(1), 2, random.Random(0))
+        first, second = [
+            G(GamePlayer, game=game, user=G(User), cards=cards,
+              player_id=player_id, disconnected=False)
+            for player_id, cards in enumerate(hands, start=1)
+        ]
+        G(GameTableSnapshot, game=game, cards_on_table=CardSet(),
+          last_cards=CardSet(), current_user=first)
+        moves = game_constants.CHECKPOINT_INTERVAL + 5
+        store = GameStateStore(flush_interval=0)
+        with store.locked(game.id) as state:
+            for move in range(moves):
+                player = rules.player_in_turn(state.table, state.ring)
+                # play, skip twice clearing the table, play and call bluff
+                if move % 5 == 4:
+                    action, outcome = 'callBluff', rules.call_bluff(
+                        state.table, player, state.ring)
+                elif move % 5 in (1, 2):
+                    action, outcome = 'skip', rules.skip(
+                        state.table, player, state.ring)
+                else:
+                    action, outcome = 'play', rules.play(
+                        state.table, player, CardSet(1 << min(player.cards)),
+                        move % 13 + 1, state.ring)
+                for changed, cards in outcome.hands.items():
+                    changed.cards = cards
+                    state.mark_dirty(changed, 'cards')
+                state.push_snapshot(GameTableSnapshot(
+                    game=state.game, action=action,
+                    **outcome.table.as_dict()), player)
+            table = state.table
+        store.release(game.id)
+
+        self.assertEqual(GameEvent.objects.filter(game=game).count(), moves)
+        self.assertEqual(
+            GameTableSnapshot.objects.filter(game=game).count(), 2)
+        replayed = Game.objects.get(id=game.id).get_current_snapshot()
+        self.assertEqual(replayed.version, moves)
+        for field in ('cards_on_table', 'last_cards', 'current_rank',
+                      'last_user_id', 'current_user_id', 'bluff_caller_id',
+                      'bluff_successful'):
+            self.assertEqual(
+                getattr(replayed, field), getattr(table, field), field)
+
+    def test_stale_update_dropped(self):
+        '''updates arriving after a later one are not sent to any client'''
+        for delta_updates in (False, True):
+            actor = GameActionsMixin()
+            actor.delta_updates = delta_updates
+            actor.last_seq = 5
+            for seq in (4, 5):
+                self.assertIsNone(actor.push_message(
+                    {'type': 'play_cards', 'seq': seq, 'game_state': {}}))
+            self.assertEqual(actor.last_seq, 5)
+
+    def test_bad_rank_refused(self):
+        user = G(User)
+        game = G(Game, owner=user, decks=1, started=True)
+        played = CardSet(1)
+        player = G(GamePlayer, game=game, user=user, cards=played,
+                   player_id=1, disconnected=False)
+        G(GamePlayer, game=game, user=G(User), cards=CardSet.full(1) - played,
+          player_id=2, disconnected=False)
+        G(GameTableSnapshot, game=game, cards_on_table=CardSet(),
+          last_cards=CardSet(), current_user=player)
+        actor = GameActionsMixin()
+        actor.room_name = game.id
+        actor.game_player = player
+        for rank in ('abc', None, '0', 14):
+            self.assertIsNone(actor.update_cards(
+                {'cardsPlayed': played.to_string(), 'set': rank}))
+        self.assertIsNotNone(actor.update_cards(
+            {'cardsPlayed': played.to_string(), 'set': '5'}))
+        with game_states.locked(game.id) as state:
+            self.assertEqual(state.table.current_rank, 5)
+
+    def test_hands_read_when_published(self):
+        '''players get their hand from the event, not the live game'''
+        user = G(User)
+        game = G(Game, owner=user, decks=1, started=True)
+        played = CardSet(1)
+        player = G(GamePlayer, game=game, user=user, cards=played,
+                   player_id=1, disconnected=False)
+        other = G(GamePlayer, game=game, user=G(User),
+                  cards=CardSet.full(1) - played, player_id=2,
+                  disconnected=False)
+        G(GameTableSnapshot, game=game, cards_on_table=CardSet(),
+          last_cards=CardSet(), current_user=player)
+        actor = GameActionsMixin()
+        actor.room_name = game.id
+        actor.game_player = player
+        event = actor.perform_action(actor.update_cards, {
+            'cardsPlayed': played.to_string(), 'set': '5'})
+        receiver = GameActionsMixin()
+        receiver.room_name = game.id
+        with game_states.locked(game.id) as state:
+            receiver.game_player = state.get_player(other.id)
+            # changed by a later action before the event is pushed
+            receiver.game_player.cards = CardSet()
+        message = receiver.push_message(event)
+        self.assertEqual(message['self']['cards'],
+                         (CardSet.full(1) - played).to_string())
+
+    def test_seat_ring_follows_connections(self):
+        user = G(User)
+        game = G(Game, owner=user, decks=1)
+        G(GameTableSnapshot, game=game,
+          cards_on_table=CardSet.full(1), last_cards=CardSet())
+        first, second, third = [
+            G(GamePlayer, game=game, user=G(User), cards=CardSet(),
+              player_id=player_id, disconnected=False)
+            for player_id in (1, 2, 3)
+        ]
+        store = GameStateStore(flush_interval=0)
+        with store.locked(game.id) as state, self.assertNumQueries(0):
+            myself = state.get_player(first.id)
+            self.assertEqual(state.next_player(myself).id, second.id)
+            state.set_connected(state.get_player(second.id), False)
+            self.assertEqual(state.next_player(myself).id, third.id)
+            self.assertEqual(
+                state.next_player(myself, connected_only=False).id, second.id)
+            self.assertEqual(
+                state.next_player(state.get_player(third.id)).id, first.id)
+
+
+class SeatAllocatorTest(TransactionTestCase):
+    '''
+    tests seats given out by concurrent joins
+    '''
+
+    def test_concurrent_joins(self):
+        table_size = 50
+        owner = G(User)
+        game = G(Game, owner=owner, decks=1, seats_taken=1)
+        G(GamePlayer, game=game, user=owner, cards=CardSet(), player_id=1)
+        GamePlayer.objects.bulk_create([
+            GamePlayer(game=game, user=G(User), cards=CardSet())
+            for i in range(200)
+        ])
+        players = list(game.gameplayer_set.filter(player_id__isnull=True))
+        # Joins come from a bounded pool, a connection per thread
+        thread_count = 20
+        barrier = threading.Barrier(thread_count)
+        seats, errors = [], []
+
+        def join(players):
+            try:
+                barrier.wait()
+                for player in players:
+                    seats.append(player.take_seat(table_size))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=join, args=(players[index::thread_count],))
+            for index in range(thread_count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        given = sorted(seat for seat in seats if seat is not None)
+        self.assertEqual(given, list(range(2, table_size + 1)))
+        self.assertEqual(Game.objects.get(id=game.id).seats_taken, table_size)
+        self.assertEqual(
+            sorted(game.gameplayer_set.exclude(
+                player_id=None).values_list('player_id', flat=True)),
+            list(range(1, table_size + 1)))
+
+    def test_seated_player_keeps_seat(self):
+        owner = G(User)
+        game = G(Game, owner=owner, decks=1, seats_taken=3)
+        player = G(GamePlayer, game=game, user=owner, cards=CardSet(),
+                   player_id=None)
+        stale = GamePlayer.objects.get(id=player.id)
+        self.assertEqual(player.take_seat(9), 4)
+        self.assertFalse(player.disconnected)
+        self.assertFalse(GamePlayer.objects.get(id=player.id).disconnected)
+        self.assertEqual(stale.take_seat(9), 4)
+        self.assertEqual(Game.objects.get(id=game.id).seats_taken, 4)
+        self.assertIsNone(G(GamePlayer, game=game, cards=CardSet(),
+                            player_id=None).take_seat(4))
+
+
+class SeatRingTest(TestCase):
+    '''
+    tests turn order of seat ring
+    '''
+
+    def test_single_player_has_no_next(self):
+        player = GamePlayer(id=1, player_id=1, disconnected=False)
+        ring = SeatRing([player, GamePlayer(id=2, player_id=None)])
+        self.assertEqual(len(ring), 1)
+        self.assertIsNone(ring.next_player(player))
+        self.assertIsNone(ring.next_player(player, connected_only=False))
+
+
+class RulesTest(TestCase):
+    '''
+    tests rules on plain players, without database
+    '''
+
+    def setUp(self):
+        self.first, self.second, self.third = [
+            rules.Player(player_id, CardSet(0b11 << (player_id * 12)))
+            for player_id in (1, 2, 3)
+        ]
+        self.ring = rules.SeatRing([self.first, self.second, self.third])
+
+    def test_bluff_caught(self):
+        table = rules.Table(current_user=self.first)
+        played = CardSet(1 << 12)  # a card of rank 2
+        outcome = rules.play(table, self.first, played, 2, self.ring)
+        self.assertIsNone(rules.play(
+            outcome.table, self.first, played, 2, self.ring))
+        table = outcome.table
+        self.first.cards = outcome.cards_of(self.first)
+        self.assertEqual(table.current_user, self.second)
+
+        outcome = rules.call_bluff(table, self.second, self.ring)
+        self.assertFalse(outcome.table.bluff_successful)
+        self.assertIs(outcome.loser, self.second)
+        self.assertEqual(outcome.cards_of(self.second),
+                         self.second.cards | played)
+        self.assertIs(outcome.table.current_user, self.first)
+        self.assertIsNone(outcome.winner)
+
+    def test_skip_back_to_last_player_clears_table(self):
+        played = CardSet(1 << 12)
+        table = rules.Table(cards_on_table=played, last_cards=played,
+                            current_rank=5, last_user=self.first,
+                            current_user=self.second)
+        table = rules.skip(table, self.second, self.ring).table
+        self.assertEqual(table.cards_on_table, played)
+        self.assertIs(table.current_user, self.third)
+        table = rules.skip(table, self.third, self.ring).table
+        self.assertIs(table.current_user, self.first)
+        table = rules.skip(table, self.first, self.ring).table
+        self.assertFalse(table.cards_on_table)
+        self.assertIsNone(table.last_user)
+        self.assertIs(table.current_user, self.first)
+
+    def test_turn_of_disconnected_player(self):
+        self.first.disconnected = True
+        self.ring.rebuild([self.first, self.second, self.third])
+        table = rules.Table(current_user=self.first)
+        self.assertIs(rules.player_in_turn(table, self.ring), self.second)
+        self.assertIsNone(rules.skip(table, self.third, self.ring))
+        outcome = rules.skip(table, self.second, self.ring)
+        self.assertIs(outcome.table.current_user, self.third)
+
+    def test_self_play(self):
+        for seed in range(5):
+            game = SelfPlayGame(4, 2, random.Random(seed),
+                                disconnect_rate=0.05)
+            winner = game.play()
+            self.assertIsNotNone(winner)
+            self.assertFalse(winner.cards)
+
+
+class TimelineStatsTest(TestCase):
+    '''
+    tests timeline built from daily stats
+    '''
+
+    def test_running_totals(self):
+        user = G(User)
+        PlayerDailyStats.increment(
+            user.id, date(2020, 10, 1), bluffs_called=2,
+            bluffs_successful=1, bluffs_failed=1, games_played=1)
+        PlayerDailyStats.increment(
+            user.id, date(2020, 10, 3), bluffs_called=1, bluffs_successful=1)
+        PlayerDailyStats.increment(
+            user.id, date(2020, 10, 3), games_played=1)
+        PlayerDailyStats.increment(
+            user.id, date(2020, 11, 1), games_played=1)
+        with self.assertNumQueries(1):
+            stats = TimelineSerializer(
+                data={'start_date': '2020-10-01T00:00:00+05:30',
+                      'end_date': '2020-10-31T00:00:00+05:30'},
+                context={'user': user})
+            stats.is_valid(raise_exception=True)
+            daily_stats = list(stats.data['daily_stats'])
+        self.assertEqual(
+            [(row.day, row.games_played) for row in daily_stats],
+            [(date(2020, 10, 1), 1), (date(2020, 10, 3), 1)])
+        self.assertEqual(daily_stats[1].bluffs_successful, 1)
+
+
+
+class StatsMigrationTest(TransactionTestCase):
+    '''
+    tests daily stats built from games played before they were counted
+    '''
+    before = [('game', '0017_snapshot_versions')]
+    after = [('game', '0018_player_daily_stats')]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        self.apps = executor.loader.project_state(self.before).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def migrate(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        return executor.loader.project_state(self.after).apps
+
+    def test_bluffs_counted_as_played(self):
+        '''a call which ends the game failed, like it does live'''
+        Game = self.apps.get_model('game', 'Game')
+        GamePlayer = self.apps.get_model('game', 'GamePlayer')
+        GameTableSnapshot = self.apps.get_model('game', 'GameTableSnapshot')
+        player, caller = G(User), G(User)
+        fives, sixes = [CardSet(RANK_MASKS[rank] & CardSet.full(1).bits)
+                        for rank in (5, 6)]
+        for played, winner in ((sixes, None), (fives, player)):
+            game = Game.objects.create(
+                owner_id=player.id, decks=1, started=True,
+                winner_id=winner and winner.id)
+            last_user, calling = [
+                GamePlayer.objects.create(game=game, user_id=user.id,
+                                          player_id=seat, cards=CardSet())
+                for seat, user in enumerate((player, caller), start=1)]
+            GameTableSnapshot.objects.create(
+                game=game, version=1, cards_on_table=played,
+                last_cards=played, current_rank=5, last_user=last_user,
+                current_user=calling)
+            # turn tells nothing, nobody has it after a call which ends
+            # the game, and the first player joining again took it
+            GameTableSnapshot.objects.create(
+                game=game, version=2, cards_on_table=CardSet(),
+                last_cards=CardSet(), bluff_caller=calling,
+                bluff_successful=True,
+                current_user=None if winner else last_user)
+        stats = self.migrate().get_model(
+            'game', 'PlayerDailyStats').objects.get(user_id=caller.id)
+        self.assertEqual(
+            (stats.bluffs_called, stats.bluffs_successful,
+             stats.bluffs_failed, stats.games_played), (2, 1, 1, 1))
+
+
+class MetricsTest(TestCase):
+    '''
+    tests per action instrumentation
+    '''
+
+    def setUp(self):
+        metrics.action_metrics.clear()
+
+    def test_queries_counted(self):
+        record = metrics.ActionRecord('play')
+        with record.tracking():
+            User.objects.count()
+            with metrics.timed('serialize'):
+                pass
+            self.assertFalse(connection.force_debug_cursor)
+        User.objects.count()  # made outside of the action
+        record.finish(log=False)
+        self.assertEqual(record.queries, 1)
+        rendered = metrics.action_metrics.render()
+        self.assertIn(
+            'game_action_queries_bucket{action="play",le="1"} 1', rendered)
+        self.assertIn('game_action_queries_count{action="play"} 1', rendered)
+
+    def test_scrape_needs_admin(self):
+        user = G(User, is_staff=False)
+        token = G(Token, user=user)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token ' + token.key
+        response = self.client.get(reverse('game_metrics'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        User.objects.filter(id=user.id).update(is_staff=True)
+        token_cache.clear()
+        response = self.client.get(reverse('game_metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class GameHistoryTest(TestCase):
+    '''
+    tests history replayed from checkpoints and events
+    '''
+
+    def setUp(self):
+        self.user = G(User)
+        self.game = G(Game, owner=self.user, decks=1, started=True,
+                      winner=self.user)
+        self.first, self.second = [
+            G(GamePlayer, game=self.game, user=user, cards=CardSet(),
+              player_id=player_id)
+            for player_id, user in ((1, self.user), (2, G(User)))
+        ]
+        for version, action, cards in ((1, 'create', CardSet.full(1)),
+                                        (2, 'start', CardSet())):
+            G(GameTableSnapshot, game=self.game, version=version,
+              action=action, cards_on_table=cards, last_cards=CardSet(),
+              current_user=self.first)
+        G(GameEvent, game=self.game, version=3, action='play', seat=1,
+          cards=CardSet(1), rank=1, next_seat=2)
+        G(GameEvent, game=self.game, version=4, action='callBluff', seat=2,
+          cards=None, rank=None, next_seat=1)
+
+    def test_history_streamed(self):
+        token = G(Token, user=self.user)
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token ' + token.key
+        response = self.client.get(
+            reverse('game_history', kwargs={'game_id': self.game.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        header, *records = [
+            json.loads(line) for line in
+            b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(header['players'], [
+            {'player_id': 1, 'user': self.user.id},
+            {'player_id': 2, 'user': self.second.user_id}])
+        self.assertEqual([(record['version'], record['action'])
+                          for record in records],
+                         [(1, 'create'), (2, 'start'), (3, 'play'),
+                          (4, 'callBluff')])
+        play, bluff = records[2:]
+        self.assertEqual(play['table']['last_cards'], play['cards'])
+        self.assertEqual(play['table']['current_player_id'], 2)
+        self.assertFalse(bluff['table']['bluff_successful'])
+        self.assertEqual(bluff['table']['bluff_caller_id'], 2)
+        self.assertEqual(bluff['table']['current_player_id'], 1)
+
+        outsider = G(Token, user=G(User))
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Token ' + outsider.key
+        response = self.client.get(
+            reverse('game_history', kwargs={'game_id': self.game.id}))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_finished_games_exported(self):
+        G(Game, owner=self.user, decks=1, winner=None)
+        with tempfile.TemporaryDirectory() as output:
+            call_command('export_games', '--finished', '--output', output,
+                         stdout=io.StringIO())
+            self.assertEqual(os.listdir(output),
+                             [f'game-{self.game.id}.ndjson.gz'])
+            with gzip.open(os.path.join(
+                    output, f'game-{self.game.id}.ndjson.gz'), 'rt') as export:
+                self.assertEqual(len(export.readlines()), 5)
+
+
+class InviteGamePlayersTest(TestCase):
+    '''
+    tests inviting many players at once
+    '''
+
+    def setUp(self):
+        self.owner = G(User)
+        self.game = G(Game, owner=self.owner, decks=1)
+        G(GamePlayer, game=self.game, user=self.owner, cards=CardSet(),
+          player_id=1)
+        self.invited = [G(User, email=f'player{i}@b.com') for i in range(3)]
+        self.request = APIRequestFactory().post(reverse('invite_players'))
+        self.request.user = self.owner
+
+    def invite(self, users):
+        return InviteGamePlayersSerializer(
+            data={'game': self.game.id,
+                  'users': [user.email for user in users]},
+            context={'request': self.request})
+
+    def test_players_invited_at_once(self):
+        serializer = self.invite(self.invited)
+        serializer.is_valid(raise_exception=True)
+        with CaptureQueriesContext(connection) as queries:
+            serializer.save()
+        inserts = [query for query in queries.captured_queries
+                   if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.game.gameplayer_set.count(), 4)
+        self.assertEqual(sorted(serializer.data['users']),
+                         [user.email for user in self.invited])
+
+    def test_invited_players_refused(self):
+        G(GamePlayer, game=self.game, user=self.invited[0], cards=CardSet())
+        serializer = self.invite(self.invited)
+        self.assertFalse(serializer.is_valid())
+        self.request.user = self.invited[1]
+        self.assertFalse(self.invite(self.invited[1:]).is_valid())
+
+
 class gameCreationTest(TestCase):
     '''
     test to check create game api
@@ -68,6 +788,15 @@ class InitGame:
     gts = None
     communicator = None
 
+    @pytest.fixture(autouse=True)
+    def no_timers(self, settings):
+        '''
+        players are disconnected as soon as their socket closes
+        and have no time limit on their turn
+        '''
+        settings.DISCONNECT_GRACE_PERIOD = 0
+        settings.TURN_TIMEOUT = 0
+
     def setUp(self, decks, player_count):
         '''
         Initializes a game, with given decks and players
@@ -210,19 +939,243 @@ class TestCallBluff(InitGame):
         await self.communicator.send_json_to(data_to_send)
         
         #No need to evaluate channel layers here
-        res = await self.communicator.receive_from()
+        await self.communicator.receive_from()
+        # moves are written to database in background
+        game_states.flush_all()
 
         # Check last user has cards '1'*156
-        assert GamePlayer.objects.get(id=self.gts.last_user.id).cards == '1'*156
+        assert GamePlayer.objects.get(
+            id=self.gts.last_user.id).cards == CardSet.from_string('1'*156)
 
         #Check new game table snapshot
-        new_snapshot = GameTableSnapshot.objects.filter(
-            game=self.game).order_by('updated_at').last()
-        assert new_snapshot.cards_on_table == '0'*156
+        new_snapshot = Game.objects.get(id=self.game.id).get_current_snapshot()
+        assert not new_snapshot.cards_on_table
         assert new_snapshot.current_user == self.self_player
         assert new_snapshot.bluff_caller == self.self_player
         assert new_snapshot.bluff_successful == True
         assert new_snapshot.last_user is None
-        assert new_snapshot.last_cards == '0'*156
+        assert not new_snapshot.last_cards
+        stats = PlayerDailyStats.objects.get(user=self.self_player.user)
+        assert stats.bluffs_called == 1
+        assert stats.bluffs_successful == 1
+        assert stats.bluffs_failed == 0
         await self.communicator.disconnect(code=1006)
-        await self.communicator.wait()
\ No newline at end of file
+        await self.communicator.wait()
+
+class TestAsyncConsumer(InitGame):
+
+    @pytest.mark.asyncio
+    async def test_async_join(self):
+        '''
+        async consumer speaks the same protocol as the sync one
+        '''
+        self.setUp(1, 2)
+        communicator = WebsocketCommunicator(
+            application,
+            f'ws/game/async/{self.game.id}/',
+            headers=[
+                (b'cookie', bytes(f'token={self.user.auth_token}', 'utf-8'))]
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        assert response['init_success']
+        assert response['self']['player_id'] == 1
+        assert response['game_table']['card_count'] == 52
+        await communicator.disconnect(code=1006)
+
+    @pytest.mark.asyncio
+    async def test_msgpack_subprotocol(self):
+        '''
+        msgpack clients get short keys and packed hands
+        '''
+        self.setUp(1, 2)
+        communicator = WebsocketCommunicator(
+            application,
+            f'ws/game/async/{self.game.id}/',
+            headers=[
+                (b'cookie', bytes(f'token={self.user.auth_token}', 'utf-8'))],
+            subprotocols=[protocol.MSGPACK_SUBPROTOCOL]
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        assert subprotocol == protocol.MSGPACK_SUBPROTOCOL
+        response = msgpack.unpackb(
+            (await communicator.receive_output())['bytes'], raw=False)
+        assert response['ok']
+        assert response['s']['pid'] == 1
+        assert response['s']['c'] == CardSet().to_bytes()
+        assert response['t']['cc'] == 52
+        await communicator.send_to(bytes_data=msgpack.packb({'a': 'unknown'}))
+        response = msgpack.unpackb(
+            (await communicator.receive_output())['bytes'], raw=False)
+        assert response == {'m': 'Invalid Action'}
+        await communicator.disconnect(code=1006)
+
+    @pytest.mark.asyncio
+    async def test_delta_updates(self):
+        '''
+        delta clients get only changes, whole state on asking
+        '''
+        self.setUp(1, 2)
+        communicator = WebsocketCommunicator(
+            application,
+            f'ws/game/async/{self.game.id}/?updates=delta',
+            headers=[
+                (b'cookie', bytes(f'token={self.user.auth_token}', 'utf-8'))]
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        assert response['init_success']
+        seq = response['seq']
+        # own join is not sent again
+        assert await communicator.receive_nothing()
+
+        other_user = self.other_players[-1].user
+        G(Token, user=other_user)
+        other = WebsocketCommunicator(
+            application,
+            f'ws/game/async/{self.game.id}/',
+            headers=[
+                (b'cookie', bytes(f'token={other_user.auth_token}', 'utf-8'))]
+        )
+        connected, subprotocol = await other.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        assert response['seq'] == seq + 1
+        assert response['patch'] == {
+            'game_players': [{'player_id': 2, 'disconnected': False}]
+        }
+
+        await communicator.send_json_to({'action': 'snapshot'})
+        response = await communicator.receive_json_from()
+        assert response['seq'] == seq + 1
+        assert response['game_players'][0]['player_id'] == 2
+        assert response['self']['player_id'] == 1
+        await other.disconnect(code=1006)
+        await communicator.disconnect(code=1006)
+
+    @pytest.mark.asyncio
+    async def test_resume(self):
+        '''
+        reconnecting player gets missed updates, others get nothing
+        '''
+        self.setUp(1, 2)
+        other_user = self.other_players[-1].user
+        G(Token, user=other_user)
+        other = WebsocketCommunicator(
+            application,
+            f'ws/game/async/{self.game.id}/',
+            headers=[
+                (b'cookie', bytes(f'token={other_user.auth_token}', 'utf-8'))]
+        )
+        connected, subprotocol = await other.connect()
+        assert connected
+        init = await other.receive_json_from()
+
+        communicator = WebsocketCommunicator(
+            application,
+            f'ws/game/async/{self.game.id}/',
+            headers=[
+                (b'cookie', bytes(f'token={self.user.auth_token}', 'utf-8'))]
+        )
+        connected, subprotocol = await communicator.connect()
+        response = await communicator.receive_json_from()
+        epoch, seq = response['epoch'], response['seq']
+        assert epoch == init['epoch']
+        await communicator.disconnect(code=1006)
+        await other.receive_json_from()  # join
+        await other.receive_json_from()  # leave
+
+        communicator = WebsocketCommunicator(
+            application,
+            f'ws/game/async/{self.game.id}/?epoch={epoch}&seq={seq}',
+            headers=[
+                (b'cookie', bytes(f'token={self.user.auth_token}', 'utf-8'))]
+        )
+        connected, subprotocol = await communicator.connect()
+        response = await communicator.receive_json_from()
+        assert response == {
+            'init_success': True, 'resumed': True,
+            'epoch': epoch, 'seq': seq}
+        response = await communicator.receive_json_from()
+        assert response['seq'] == seq + 1
+        assert await other.receive_nothing()
+        await communicator.disconnect(code=1006)
+        await other.disconnect(code=1006)
+
+    @pytest.mark.asyncio
+    async def test_reconnect_within_grace_period(self, settings):
+        '''
+        player coming back before the grace period ends stays connected
+        and others hear nothing of it
+        '''
+        settings.DISCONNECT_GRACE_PERIOD = 0.5
+        self.setUp(1, 2)
+        other_user = self.other_players[-1].user
+        G(Token, user=other_user)
+        other = WebsocketCommunicator(
+            application,
+            f'ws/game/async/{self.game.id}/',
+            headers=[
+                (b'cookie', bytes(f'token={other_user.auth_token}', 'utf-8'))]
+        )
+        connected, subprotocol = await other.connect()
+        await other.receive_json_from()
+
+        for attempt in range(2):
+            communicator = WebsocketCommunicator(
+                application,
+                f'ws/game/async/{self.game.id}/',
+                headers=[
+                    (b'cookie', bytes(f'token={self.user.auth_token}', 'utf-8'))]
+            )
+            connected, subprotocol = await communicator.connect()
+            response = await communicator.receive_json_from()
+            assert response['init_success']
+            assert response['self']['player_id'] == 1
+            await communicator.disconnect(code=1006)
+        await other.receive_json_from()  # first join only
+        assert await other.receive_nothing(0.2)
+
+        # Nobody came back this time
+        response = await other.receive_json_from(timeout=2)
+        player = next(player for player in response['game_players']
+                      if player['player_id'] == 1)
+        assert player['disconnected']
+        settings.DISCONNECT_GRACE_PERIOD = 0
+        await other.disconnect(code=1006)
+
+    @pytest.mark.asyncio
+    async def test_turn_timeout(self, settings):
+        '''
+        turn of an idle player is skipped and counted in his no_action
+        '''
+        settings.TURN_TIMEOUT = 0.3
+        self.setUp(1, 2)
+        Game.objects.filter(id=self.game.id).update(started=True)
+        other_player = self.other_players[-1]
+        other_player.disconnected = False
+        other_player.cards = '1' + '0'*155
+        other_player.save()
+        GameTableSnapshot.objects.filter(id=self.gts.id).update(
+            current_user=self.self_player)
+
+        communicator = WebsocketCommunicator(
+            application,
+            f'ws/game/async/{self.game.id}/',
+            headers=[
+                (b'cookie', bytes(f'token={self.user.auth_token}', 'utf-8'))]
+        )
+        connected, subprotocol = await communicator.connect()
+        response = await communicator.receive_json_from()
+        assert response['game_table']['current_player_id'] == 1
+
+        response = await communicator.receive_json_from(timeout=2)
+        assert response['action'] == 'skip'
+        assert response['game_table']['current_player_id'] == 2
+        game_states.flush_all()
+        assert GamePlayer.objects.get(id=self.self_player.id).no_action == 1
+        settings.TURN_TIMEOUT = 0
+        await communicator.disconnect(code=1006)
@@ -0,0 +1,120 @@
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class TimingWheel:
+    '''
+    Hashed timing wheel running callbacks of timers on a daemon thread
+    Scheduling and cancelling are O(1), every tick only looks at the
+    timers of one slot, so many idle games cost next to nothing
+
+    Timers are identified by a key, scheduling a key again replaces
+    its timer. Callbacks must be short, they delay the following ones
+    '''
+
+    def __init__(self, tick=0.1, slot_count=512):
+        self.tick = tick
+        self.slots = [{} for i in range(slot_count)]  # key -> timer
+        self._timers = {}  # key -> slot holding its timer
+        self._ticks = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, key, delay, callback, *args):
+        '''Runs callback(*args) after delay seconds unless cancelled'''
+        deadline_offset = max(1, math.ceil(delay / self.tick))
+        with self._lock:
+            self._remove(key)
+            deadline = self._ticks + deadline_offset
+            slot = self.slots[deadline % len(self.slots)]
+            slot[key] = (deadline, callback, args)
+            self._timers[key] = slot
+            self._start()
+
+    def cancel(self, key):
+        '''Returns whether a pending timer was cancelled'''
+        with self._lock:
+            return self._remove(key)
+
+    def pending(self, key):
+        with self._lock:
+            return key in self._timers
+
+    def _remove(self, key):
+        slot = self._timers.pop(key, None)
+        if slot is None:
+            return False
+        del slot[key]
+        return True
+
+    def advance(self):
+        '''Moves the wheel by one tick and runs the timers due'''
+        with self._lock:
+            self._ticks += 1
+            slot = self.slots[self._ticks % len(self.slots)]
+            due = [(key, callback, args)
+                   for key, (deadline, callback, args) in slot.items()
+                   if deadline <= self._ticks]
+            for key, callback, args in due:
+                self._remove(key)
+        for key, callback, args in due:
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception('Timer %s failed', key)
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='game-timing-wheel', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            time.sleep(max(0, next_tick - time.monotonic()))
+            self.advance()
+            next_tick += self.tick
+
+
+game_timers = TimingWheel()
+# Threads running timer callbacks which use the database, off the wheel
+timer_workers = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix='game-timer-worker')
+
+
+def in_worker(callback):
+    '''
+    Returns a timer callback handing callback over to timer_workers, so
+    that its queries never hold up the wheel. Connection of the worker
+    is recycled around every call
+    '''
+    def submit(*args):
+        timer_workers.submit(_run_in_worker, callback, args)
+    return submit
+
+
+def _run_in_worker(callback, args):
+    close_old_connections()
+    try:
+        callback(*args)
+    except Exception:
+        logger.exception('Timer callback %s failed', callback)
+    finally:
+        close_old_connections()
+
+
+def main_event_loop():
+    '''
+    Returns event loop of the server when called from code it runs in a
+    thread, so that timers can send to the channel layer on that loop
+    '''
+    return getattr(SyncToAsync.threadlocal, 'main_event_loop', None)
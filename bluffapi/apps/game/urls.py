@@ -4,10 +4,13 @@ from rest_framework import routers
 
 from apps.game.views import (
     CreateGamePlayer,
+    InviteGamePlayers,
     TimelineStats,
     ListInvitedPlayers,
     GameViewset,
-    GameStats
+    GameStats,
+    GameHistory,
+    GameMetrics
 )
 
 router = routers.SimpleRouter()
@@ -15,10 +18,14 @@ router.register(r'', GameViewset, basename='game')
 
 urlpatterns = [
     url('player', CreateGamePlayer.as_view(), name='create_player'),
+    url(r'^invite$', InviteGamePlayers.as_view(), name='invite_players'),
     url('stats', TimelineStats.as_view(), name='timeline_stats'),
+    url(r'^metrics$', GameMetrics.as_view(), name='game_metrics'),
     url(r'^(?P<game_id>\d+)/invitedList',
         ListInvitedPlayers().as_view(), name='invitedList'),
     url(r'^(?P<game_id>\d+)/info',
-        GameStats.as_view(), name='game_stats')
+        GameStats.as_view(), name='game_stats'),
+    url(r'^(?P<game_id>\d+)/history$',
+        GameHistory.as_view(), name='game_history')
 ]
 urlpatterns += (router.urls)
@@ -1,4 +1,5 @@
 from django.shortcuts import render
+from django.http import HttpResponse, StreamingHttpResponse
 from django.db import IntegrityError
 from django.db.models import Q
 
@@ -6,19 +7,20 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, exceptions
 from rest_framework.generics import ListAPIView, CreateAPIView
-from rest_framework import viewsets
+from rest_framework import viewsets, permissions
 from rest_framework.mixins import CreateModelMixin, ListModelMixin
 from django.core.mail import send_mail
 from django.conf import settings
-from apps.accounts.tasks import send_invite_mail
+from apps.accounts.tasks import send_invite_mail, send_invite_mails
 
-from apps.game import filter_classes
+from apps.game import filter_classes, history, metrics
 from apps.game.mixins.accessMixins import LoggedInMixin
 from apps.game import constants as game_constants
 from apps.game.models import Game, GamePlayer
 from apps.game.serializers import (
     CreateGameSerializer,
     CreateGamePlayerSerializer,
+    InviteGamePlayersSerializer,
     GameSerializer,
     TimelineSerializer,
     InvitedPlayerSerializer,
@@ -29,6 +31,14 @@ from apps.game.serializers import (
 # Create your views here.
 
 
+def invite_mail(game, recipient_list):
+    '''Returns (subject, message, email_from, recipient_list) of an invite'''
+    game_url = f'{game_constants.DOMAIN}/game/{game.id}'
+    message = f'{game_constants.MESSAGE} {game.owner} join right away by going to {game_url}'
+    return (game_constants.SUBJECT, message, settings.EMAIL_HOST_USER,
+            recipient_list)
+
+
 class GameViewset(LoggedInMixin, viewsets.GenericViewSet, CreateModelMixin, ListModelMixin,):
 
     filterset_class = filter_classes.GamesFilterSet
@@ -66,18 +76,27 @@ class CreateGamePlayer(LoggedInMixin, CreateAPIView):
 
     def post(self, request):
         response = super(CreateGamePlayer, self).post(request)
-        game_id = response.data['game']
-        invited_user = response.data['user']
-        subject = game_constants.SUBJECT
-        game_owner = Game.objects.filter(id=game_id).first().owner
-        game_url = f'{game_constants.DOMAIN}/game/{game_id}'
-        message = f'{game_constants.MESSAGE} {game_owner} join right away by going to {game_url}'
-        email_from = settings.EMAIL_HOST_USER
-        recipient_list = [invited_user]
-        send_invite_mail.delay(subject, message, email_from, recipient_list)
+        game = Game.objects.select_related('owner').get(
+            id=response.data['game'])
+        send_invite_mail.delay(*invite_mail(game, [response.data['user']]))
         return response
 
 
+class InviteGamePlayers(LoggedInMixin, CreateAPIView):
+    '''
+    Invites many players to a game at once
+    Their mails are sent by a single task over one connection
+    '''
+    serializer_class = InviteGamePlayersSerializer
+
+    def perform_create(self, serializer):
+        invites = serializer.save()
+        game = invites['game']
+        send_invite_mails.delay([
+            invite_mail(game, [user.email]) for user in invites['users']
+        ])
+
+
 # This view is WIP, and  intended for stats part of project, also WIP
 # Therefore review fixes are not present here
 
@@ -92,15 +111,21 @@ class TimelineStats(LoggedInMixin, APIView):
             'user': self.request.user})
         serializer.is_valid(raise_exception=True)
 
-        def graph(queryset):
+        def graph(daily_stats, field):
+            '''Returns (running total, day) for days on which field changed'''
             graph = []
-            for index, row in enumerate(queryset):
-                graph.append((index+1, row.created_at))
+            total = 0
+            for row in daily_stats:
+                count = getattr(row, field)
+                if count:
+                    total += count
+                    graph.append((total, row.day))
             return graph
+        daily_stats = list(serializer.data['daily_stats'])
         return Response({
-            'successful_bluffs': graph(serializer.data['successful_bluffs']),
-            'unsuccessful_bluffs': graph(serializer.data['unsuccessful_bluffs']),
-            'games_played': graph(serializer.data['all_game_players'])
+            'successful_bluffs': graph(daily_stats, 'bluffs_successful'),
+            'unsuccessful_bluffs': graph(daily_stats, 'bluffs_failed'),
+            'games_played': graph(daily_stats, 'games_played')
         })
 
 
@@ -141,3 +166,30 @@ class GameStats(LoggedInMixin, ListAPIView):
         # Winner: ''
         # No of Players: 5,
         # Player_Name: Cards Left
+
+
+class GameHistory(LoggedInMixin, APIView):
+    '''
+    Streams every version of a game as newline delimited JSON
+    '''
+
+    def get(self, request, game_id):
+        game = Game.objects.filter(id=game_id).first()
+        if not game:
+            raise exceptions.ValidationError("This game does not exist")
+        if not game.gameplayer_set.filter(user=request.user).exists():
+            raise exceptions.ValidationError("You are not Part of this game")
+        return StreamingHttpResponse(history.history_lines(game),
+                                     content_type='application/x-ndjson')
+
+
+class GameMetrics(APIView):
+    '''
+    Returns histograms of websocket actions handled by this process
+    in prometheus text format
+    '''
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return HttpResponse(metrics.action_metrics.render(),
+                            content_type='text/plain; version=0.0.4')
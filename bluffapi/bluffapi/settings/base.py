@@ -39,6 +39,37 @@ INSTALLED_APPS = [
 ]
 
 ASGI_APPLICATION = "bluffapi.routing.application"
+# consumer serving ws/game/<game_id>/, 'sync' or 'async'
+GAME_CONSUMER = env('GAME_CONSUMER', default='sync')
+# tokens kept by every worker and seconds a cached token stays valid
+# Logging out forgets the token only in the worker serving the logout,
+# other workers accept it for up to TOKEN_CACHE_TTL seconds more
+TOKEN_CACHE_SIZE = env.int('TOKEN_CACHE_SIZE', default=10000)
+TOKEN_CACHE_TTL = env.int('TOKEN_CACHE_TTL', default=60)
+# seconds a player stays connected after his socket closes, 0 to disconnect
+# him right away
+DISCONNECT_GRACE_PERIOD = env.float('DISCONNECT_GRACE_PERIOD', default=5)
+# seconds a player has to play his turn before it is skipped, 0 for no limit
+TURN_TIMEOUT = env.float('TURN_TIMEOUT', default=60)
+# no of players who can be seated in a game
+TABLE_SIZE = env.int('TABLE_SIZE', default=9)
+# One line per websocket action with its query count and timings
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'apps.game.metrics': {
+            'handlers': ['console'],
+            'level': env('GAME_METRICS_LOG_LEVEL', default='INFO'),
+            'propagate': False,
+        },
+    },
+}
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -78,7 +109,7 @@ TEMPLATES = [
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',),
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'bluffapi.token_auth.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
 
     ],
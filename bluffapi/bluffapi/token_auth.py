@@ -1,25 +1,128 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
 from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from django.conf import settings
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
 from rest_framework.authtoken.models import Token
 from django.contrib.auth.models import AnonymousUser
 
 
+class TokenCache:
+    '''
+    Bounded least recently used cache of token key -> user
+    Entries expire after ttl seconds, so tokens deleted by another
+    worker stop being accepted here after at most ttl seconds
+    Users are copied in and out, every request gets an instance of its
+    own which it may change without touching the cache
+    '''
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (user, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns cached user of the token or None'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return copy.deepcopy(user)
+
+    def set(self, key, user):
+        if not self.maxsize:
+            return
+        user = copy.deepcopy(user)
+        with self._lock:
+            self._entries[key] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        '''
+        Forgets all tokens of the user in this process, other workers
+        accept them till their entries expire
+        '''
+        with self._lock:
+            for key in [key for key, (user, expires_at)
+                        in self._entries.items() if user.id == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def lookup(self, key):
+        '''
+        Returns user owning the token, querying database on a cache miss
+        Raises Token.DoesNotExist for unknown tokens
+        '''
+        user = self.get(key)
+        if user is None:
+            user = Token.objects.select_related('user').get(key=key).user
+            self.set(key, user)
+        return user
+
+
+token_cache = TokenCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    '''
+    DRF TokenAuthentication answering from token_cache
+    '''
+
+    def authenticate_credentials(self, key):
+        try:
+            user = token_cache.lookup(key)
+        except Token.DoesNotExist:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return (user, user.auth_token)
+
+
 class TokenAuthMiddleware:
     """
     Token authorization middleware for Django Channels 2
+    Tokens found in token_cache are resolved without leaving the event
+    loop, others are looked up in a thread
     """
 
     def __init__(self, inner):
         self.inner = inner
 
     def __call__(self, scope):
+        return partial(self.coroutine_call, dict(scope))
+
+    def get_key(self, scope):
         headers = dict(scope['headers'])
+        return str(headers[b'cookie']).split('=')[-1][:-1]
+
+    async def coroutine_call(self, scope, receive, send):
         try:
-            key = str(headers[b'cookie']).split('=')[-1][:-1]
-            token = Token.objects.get(key=key)
-            scope['user'] = token.user
+            key = self.get_key(scope)
+            user = token_cache.get(key)
+            if user is None:
+                user = await database_sync_to_async(token_cache.lookup)(key)
+            scope['user'] = user
         except:
             scope['user'] = AnonymousUser()
-        return self.inner(scope)
+        inner_instance = self.inner(scope)
+        await inner_instance(receive, send)
 
 def TokenAuthMiddlewareStack(inner): return TokenAuthMiddleware(
     AuthMiddlewareStack(inner))